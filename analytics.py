@@ -0,0 +1,173 @@
+import threading
+import time
+from datetime import timezone
+import numpy as np
+from sqlalchemy import text
+from models import db, Currency
+from branches import ALL_BRANCHES
+from changes import latest_seq
+
+# Transaction columns are loaded once into NumPy arrays and then topped up with
+# rows whose id is above the cached max id. Edits and deletes in this process
+# call invalidate(). Those made by other workers show up as U/D rows in
+# change_log after the seq the arrays were loaded at, which is a seek on the
+# change_log primary key. A TTL reload backs this up.
+FULL_RELOAD_SECONDS = 300
+
+COLUMNS = ('id', 'ts', 'currency_id', 'branch_id', 'side', 'quantity', 'buy_rate', 'sell_rate', 'total_local', 'profit')
+
+_SELECT = """
+    SELECT id,
+           CAST(strftime('%s', date) AS INTEGER),
+           coalesce(currency_id, -1),
+           coalesce(branch_id, -1),
+           CASE WHEN type = 'buy' THEN 1 ELSE -1 END,
+           coalesce(quantity, 0),
+           coalesce(buy_rate, 0),
+           coalesce(sell_rate, 0),
+           coalesce(total_value_local, 0),
+           coalesce(profit, 0)
+    FROM "transaction" WHERE id > :after AND date IS NOT NULL ORDER BY id
+"""
+
+_EDITS = """
+    SELECT max(seq), coalesce(max(op != 'I'), 0) FROM change_log
+    WHERE seq > :after AND table_name = 'transaction'
+"""
+
+
+class TransactionColumns:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._loaded_at = 0.0
+        self._seq = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+    def _fetch(self, after):
+        # Plain DB-API tuples convert to an array far faster than Row objects
+        cursor = db.session.connection().connection.cursor()
+        try:
+            rows = cursor.execute(_SELECT.replace(':after', '?'), (after,)).fetchall()
+        finally:
+            cursor.close()
+        arr = np.array(rows, dtype=np.float64).reshape(-1, len(COLUMNS))
+        data = {name: arr[:, i] for i, name in enumerate(COLUMNS)}
+        for name in ('id', 'ts', 'currency_id', 'branch_id', 'side'):
+            data[name] = data[name].astype(np.int64)
+        return data
+
+    def get(self):
+        """Return the column dict, refreshed incrementally by max id."""
+        with self._lock:
+            stale = self._data is None or time.monotonic() - self._loaded_at > FULL_RELOAD_SECONDS
+            if not stale:
+                seq, edited = db.session.execute(text(_EDITS), {'after': self._seq}).one()
+                if edited:
+                    stale = True  # rows were edited or deleted elsewhere
+                else:
+                    max_id = int(self._data['id'][-1]) if len(self._data['id']) else 0
+                    new = self._fetch(max_id)
+                    if len(new['id']):
+                        self._data = {k: np.concatenate((self._data[k], new[k])) for k in COLUMNS}
+                    self._seq = seq or self._seq
+            if stale:
+                # Read the seq first: a change committed during the load is seen again next time
+                self._seq = latest_seq()
+                self._data = self._fetch(0)
+                self._loaded_at = time.monotonic()
+            return self._data
+
+
+columns = TransactionColumns()
+
+
+def select(data, branch_id=ALL_BRANCHES, currency_id=None, start=None, end=None):
+    mask = np.ones(len(data['id']), dtype=bool)
+    if branch_id is not ALL_BRANCHES:
+        mask &= data['branch_id'] == (-1 if branch_id is None else branch_id)
+    if currency_id is not None:
+        mask &= data['currency_id'] == currency_id
+    # Stored dates are naive UTC
+    if start is not None:
+        mask &= data['ts'] >= int(start.replace(tzinfo=timezone.utc).timestamp())
+    if end is not None:
+        mask &= data['ts'] < int(end.replace(tzinfo=timezone.utc).timestamp())
+    return {k: v[mask] for k, v in data.items()}
+
+
+def volume_series(data, freq='day'):
+    """Traded local value, quantity and trade count per day or hour bucket."""
+    step = 3600 if freq == 'hour' else 86400
+    if not len(data['ts']):
+        return {'t': [], 'value': [], 'quantity': [], 'count': []}
+    buckets = data['ts'] // step
+    uniq, inverse = np.unique(buckets, return_inverse=True)
+    return {
+        't': (uniq * step).tolist(),
+        'value': np.bincount(inverse, weights=data['total_local']).tolist(),
+        'quantity': np.bincount(inverse, weights=data['quantity']).tolist(),
+        'count': np.bincount(inverse).tolist(),
+    }
+
+
+def daily_rates(data, currency_id):
+    """Average traded rate per day for one currency, as (day_index, rate) arrays."""
+    sel = data['currency_id'] == currency_id
+    rate = np.where(data['side'][sel] == 1, data['buy_rate'][sel], data['sell_rate'][sel])
+    days = data['ts'][sel] // 86400
+    ok = rate > 0
+    if not ok.any():
+        return np.array([], dtype=np.int64), np.array([])
+    uniq, inverse = np.unique(days[ok], return_inverse=True)
+    return uniq, np.bincount(inverse, weights=rate[ok]) / np.bincount(inverse)
+
+
+def currency_summary(data, confidence=0.95):
+    """Per-currency net position, spread, exposure and one-day historical VaR.
+
+    Exposure is the net held quantity valued at the current rate; VaR applies
+    the observed distribution of daily changes of the traded rate to it. The
+    total VaR is the sum over currencies (no diversification benefit assumed).
+    """
+    currencies = {c.id: c for c in Currency.query.all()}
+    ids, inverse = np.unique(data['currency_id'], return_inverse=True)
+    n = len(ids)
+    counts = np.bincount(inverse, minlength=n)
+    net_qty = np.bincount(inverse, weights=data['quantity'] * data['side'], minlength=n)
+    spread_sum = np.bincount(inverse, weights=data['sell_rate'] - data['buy_rate'], minlength=n)
+    value = np.bincount(inverse, weights=data['total_local'], minlength=n)
+    profit = np.bincount(inverse, weights=data['profit'], minlength=n)
+
+    rows = []
+    for i, cid in enumerate(ids.tolist()):
+        c = currencies.get(cid)
+        if c is None:
+            continue
+        exposure = net_qty[i] * (c.rate or 0)
+        _, rates = daily_rates(data, cid)
+        var = 0.0
+        if len(rates) > 2:
+            returns = np.diff(rates) / rates[:-1]
+            var = float(max(0.0, -np.quantile(returns * exposure, 1 - confidence)))
+        rows.append({
+            'currency': c.code,
+            'trades': int(counts[i]),
+            'volume_local': float(value[i]),
+            'profit': float(profit[i]),
+            'avg_spread': float(spread_sum[i] / counts[i]) if counts[i] else 0.0,
+            'net_position': float(net_qty[i]),
+            'rate': c.rate,
+            'exposure': float(exposure),
+            'exposure_per_1pct': float(exposure * 0.01),
+            'var': var,
+        })
+    return {
+        'confidence': confidence,
+        'currencies': rows,
+        'total_exposure': float(sum(abs(r['exposure']) for r in rows)),
+        'total_var': float(sum(r['var'] for r in rows)),
+    }
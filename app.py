@@ -3,20 +3,38 @@
 # ----------------------------------------------------------------------
 
 # Flask and Flask-related imports
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, render_template_string
+from flask import (Flask, render_template, redirect, url_for, request, flash, jsonify, render_template_string, abort,
+                   Response, stream_with_context)
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 
 # Models, Config, and Database
-from models import db, User, Settings, Currency, Transaction, Cashbox, Expense, ExchangeDiff, Debt
+from models import db, configure_sqlite, ensure_schema, User, Settings, Currency, Transaction, Cashbox, Expense, ExchangeDiff, Debt, DailyClose, Branch, PairSpread
 import config
 import bcrypt
+from functools import wraps
 
 # Forms
-from forms import LoginForm, UserForm, SettingsForm, CurrencyForm, TransactionForm, ExpenseForm, DebtForm
+from forms import LoginForm, UserForm, SettingsForm, CurrencyForm, TransactionForm, ExpenseForm, DebtForm, CloseDayForm, BranchForm, PairSpreadForm
 
 # Utilities
-from utils import export_transactions_excel, export_expenses_excel, render_pdf_from_html
-import pandas as pd
+from utils import export_transactions_excel, export_expenses_excel, render_pdf_from_html, preload_exports
+from closing import is_day_closed, close_day, balance_as_of, last_closed_day
+from debt_reports import AGING_BUCKETS, aging_report, exposure_by_person, overdue_summary, person_prefix
+from search import search as search_index, ensure_search_index
+from branches import (ALL_BRANCHES, HEAD_OFFICE_NAME, user_branch_id, posting_branch_id, apply_scope,
+                      latest_balances, consolidated_report)
+from ledger import post_cashbox, repost_source, transaction_flows
+from changes import latest_seq, iter_change_batches, to_ndjson, ensure_change_log
+import quotes
+import charts
+import backup
+from positions import record_transaction, recompute_from, positions_report
+import analytics
+import assets
+import compression
+import templating
+from datetime import datetime, timedelta
+import math
 
 # ----------------------------------------------------------------------
 # 2. إنشاء التطبيق (App Creation Function)
@@ -29,11 +47,27 @@ def create_app():
 
     # Initialize extensions
     db.init_app(app)
+    configure_sqlite(app)
+    # Bring databases created by older versions up to date (tables, columns,
+    # indexes, search index and change triggers) before the first query
+    with app.app_context():
+        ensure_schema()
+        ensure_search_index()
+        ensure_change_log()
 
     login_manager = LoginManager()
     login_manager.init_app(app)
     login_manager.login_view = 'login'
 
+    # Fingerprinted CSS/JS bundles (static/dist, rebuilt here when stale)
+    assets.init_app(app)
+    # gzip/brotli for dynamic responses, bytecode + fragment caching for templates
+    compression.init_app(app)
+    templating.init_app(app)
+    # Long-running workers can load the export stack up front (PRELOAD_EXPORTS=1)
+    if app.config.get('PRELOAD_EXPORTS'):
+        preload_exports()
+
     @login_manager.user_loader
     def load_user(user_id):
         return User.query.get(int(user_id))
@@ -64,6 +98,7 @@ def create_app():
 
     def require_admin_permission(f):
         """يتطلب أن يكون دور المستخدم 'admin'."""
+        @wraps(f)
         @login_required
         def decorated_function(*args, **kwargs):
             if current_user.role == 'admin':
@@ -71,11 +106,11 @@ def create_app():
             else:
                 flash('ليس لديك صلاحية للوصول إلى هذه الصفحة')
                 return redirect(url_for('dashboard'))
-        decorated_function.__name__ = f.__name__ + '_admin_required'
         return decorated_function
 
     def require_editor_permission(f):
         """يتطلب أن يكون دور المستخدم 'admin' أو 'editor'."""
+        @wraps(f)
         @login_required
         def decorated_function(*args, **kwargs):
             if current_user.role in ['admin', 'editor']:
@@ -83,11 +118,11 @@ def create_app():
             else:
                 flash('ليس لديك صلاحية للوصول إلى هذه الصفحة')
                 return redirect(url_for('dashboard'))
-        decorated_function.__name__ = f.__name__ + '_editor_required'
         return decorated_function
 
     def require_general_permission(f):
         """يسمح لجميع الأدوار بالوصول، لكن يقيد 'viewer' على طرق GET فقط."""
+        @wraps(f)
         @login_required
         def decorated_function(*args, **kwargs):
             if current_user.role == 'admin' or current_user.role == 'editor':
@@ -101,9 +136,17 @@ def create_app():
             else:
                 flash('ليس لديك صلاحية للوصول إلى هذه الصفحة')
                 return redirect(url_for('dashboard'))
-        decorated_function.__name__ = f.__name__ + '_general_required'
         return decorated_function
 
+    def check_branch_access(obj):
+        """يمنع مستخدمي الفروع من الوصول إلى سجلات فرع آخر."""
+        scope = user_branch_id()
+        if scope is not ALL_BRANCHES and obj.branch_id != scope:
+            abort(404)
+
+    def branch_choices():
+        return [(0, HEAD_OFFICE_NAME)] + [(b.id, b.name) for b in Branch.query.order_by(Branch.name).all()]
+
     # ----------------------------------------------------------------------
     # 5. مسارات التوثيق (Authentication Routes)
     # ----------------------------------------------------------------------
@@ -133,23 +176,22 @@ def create_app():
     @app.route('/')
     @login_required
     def dashboard():
+        scope = user_branch_id()
         total_currencies = Currency.query.count()
-        latest_tx = Transaction.query.order_by(Transaction.date.desc()).limit(10).all()
+        latest_tx = apply_scope(Transaction.query, Transaction, scope).order_by(Transaction.date.desc()).limit(10).all()
         currencies = Currency.query.all()
         # Coalesce is important for SUM on empty table to return 0 instead of None
-        total_profit = db.session.query(db.func.coalesce(db.func.sum(Transaction.profit),0)).scalar() or 0
-        total_expenses = db.session.query(db.func.coalesce(db.func.sum(Expense.amount),0)).scalar() or 0
+        total_profit = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Transaction.profit),0)), Transaction, scope).scalar() or 0
+        total_expenses = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Expense.amount),0)), Expense, scope).scalar() or 0
         
         # Get latest cashbox balances grouped by currency
-        balances = {}
-        for c in currencies:
-            last = Cashbox.query.filter_by(currency_id=c.id).order_by(Cashbox.date.desc()).first()
-            balances[c.code] = last.balance_after if last else 0
+        balances = latest_balances(scope)
             
+        overdue = overdue_summary(datetime.utcnow().date(), branch_id=scope)
         settings = Settings.query.first()
         return render_template('dashboard.html', total_currencies=total_currencies, latest_tx=latest_tx, 
                                currencies=currencies, total_profit=total_profit, total_expenses=total_expenses, 
-                               balances=balances, settings=settings)
+                               balances=balances, overdue=overdue, settings=settings)
 
     @app.route('/settings', methods=['GET', 'POST'])
     @login_required
@@ -170,7 +212,21 @@ def create_app():
                 return redirect(url_for('settings'))
             
         form = SettingsForm(obj=settings) if current_user.role == 'admin' else None
-        return render_template('settings.html', settings=settings, form=form)
+        backups = backup.list_backups(app.config['BACKUP_DIR'])[:10] if current_user.role == 'admin' else []
+        return render_template('settings.html', settings=settings, form=form, backups=backups,
+                               backup_status=backup.status)
+
+    @app.route('/backup', methods=['POST'])
+    @require_admin_permission
+    def backup_now():
+        """نسخة احتياطية فورية أثناء العمل (تعمل في الخلفية دون إيقاف الصرافين)."""
+        try:
+            started = backup.start_background(app)
+        except backup.BackupError as e:
+            flash(f'تعذر إنشاء النسخة الاحتياطية: {e}')
+            return redirect(url_for('settings'))
+        flash('بدأ إنشاء النسخة الاحتياطية' if started else 'يوجد نسخ احتياطي قيد التنفيذ')
+        return redirect(url_for('settings'))
 
     # ----------------------------------------------------------------------
     # 7. مسارات إدارة المستخدمين (User Management Routes)
@@ -187,6 +243,7 @@ def create_app():
     @require_admin_permission
     def user_add():
         form = UserForm()
+        form.branch_id.choices = branch_choices()
         settings = Settings.query.first()
         if form.validate_on_submit():
             if User.query.filter_by(username=form.username.data).first():
@@ -196,7 +253,8 @@ def create_app():
             password_data = form.password.data or "password123"
             password_hash = bcrypt.hashpw(password_data.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
             
-            user = User(username=form.username.data, password_hash=password_hash, role=form.role.data)
+            user = User(username=form.username.data, password_hash=password_hash, role=form.role.data,
+                        branch_id=form.branch_id.data or None)
             db.session.add(user)
             db.session.commit()
             flash('تم إضافة المستخدم بنجاح')
@@ -213,10 +271,12 @@ def create_app():
             return redirect(url_for('users'))
             
         form = UserForm(obj=user)
+        form.branch_id.choices = branch_choices()
         settings = Settings.query.first()
         if form.validate_on_submit():
             user.username = form.username.data
             user.role = form.role.data
+            user.branch_id = form.branch_id.data or None
             
             if form.password.data:
                 user.password_hash = bcrypt.hashpw(form.password.data.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -225,6 +285,9 @@ def create_app():
             flash('تم تحديث بيانات المستخدم بنجاح')
             return redirect(url_for('users'))
             
+        elif request.method == 'GET':
+            form.branch_id.data = user.branch_id or 0
+
         return render_template('user_form.html', form=form, user=user, settings=settings)
 
     @app.route('/user/delete/<int:id>', methods=['POST'])
@@ -240,6 +303,46 @@ def create_app():
         flash('تم حذف المستخدم بنجاح')
         return redirect(url_for('users'))
 
+    @app.route('/branches')
+    @require_admin_permission
+    def branches():
+        rows = Branch.query.order_by(Branch.name).all()
+        settings = Settings.query.first()
+        return render_template('branches.html', branches=rows, settings=settings)
+
+    @app.route('/branch/add', methods=['GET', 'POST'])
+    @require_admin_permission
+    def branch_add():
+        form = BranchForm()
+        settings = Settings.query.first()
+        if form.validate_on_submit():
+            if Branch.query.filter((Branch.name == form.name.data) | (Branch.code == form.code.data.upper())).first():
+                flash('اسم الفرع أو رمزه موجود بالفعل')
+                return render_template('branch_form.html', form=form, settings=settings)
+            db.session.add(Branch(name=form.name.data, code=form.code.data.upper()))
+            db.session.commit()
+            flash('تم إضافة الفرع بنجاح')
+            return redirect(url_for('branches'))
+        return render_template('branch_form.html', form=form, settings=settings)
+
+    @app.route('/branch/edit/<int:id>', methods=['GET', 'POST'])
+    @require_admin_permission
+    def branch_edit(id):
+        branch = Branch.query.get_or_404(id)
+        form = BranchForm(obj=branch)
+        settings = Settings.query.first()
+        if form.validate_on_submit():
+            if Branch.query.filter((Branch.name == form.name.data) | (Branch.code == form.code.data.upper()),
+                                   Branch.id != branch.id).first():
+                flash('اسم الفرع أو رمزه موجود بالفعل')
+                return render_template('branch_form.html', form=form, branch=branch, settings=settings)
+            branch.name = form.name.data
+            branch.code = form.code.data.upper()
+            db.session.commit()
+            flash('تم تحديث الفرع بنجاح')
+            return redirect(url_for('branches'))
+        return render_template('branch_form.html', form=form, branch=branch, settings=settings)
+
     # ----------------------------------------------------------------------
     # 8. مسارات إدارة العملات (Currency Management Routes)
     # ----------------------------------------------------------------------
@@ -264,6 +367,7 @@ def create_app():
             )
             db.session.add(c)
             db.session.commit()
+            quotes.engine.rebuild()
             flash('تم إضافة العملة')
             return redirect(url_for('currencies'))
             
@@ -279,7 +383,10 @@ def create_app():
             currency.code = form.code.data.upper()
             currency.name = form.name.data
             currency.rate = form.rate.data
+            currency.last_update = datetime.utcnow()
             db.session.commit()
+            # New cross rates take effect for the next quote
+            quotes.engine.rebuild()
             flash('تم تحديث العملة')
             return redirect(url_for('currencies'))
             
@@ -289,11 +396,55 @@ def create_app():
     @require_editor_permission
     def currency_delete(id):
         currency = Currency.query.get_or_404(id)
+        PairSpread.query.filter(db.or_(PairSpread.from_currency_id == id, PairSpread.to_currency_id == id)).delete()
         db.session.delete(currency)
         db.session.commit()
+        quotes.engine.rebuild()
         flash('تم حذف العملة')
         return redirect(url_for('currencies'))
 
+    @app.route('/quotes')
+    @require_general_permission
+    def quotes_view():
+        """أداة التسعير للصراف: تحويل بين عملتين وجدول الأسعار المتقاطعة."""
+        codes, matrix = quotes.engine.matrix()
+        form = None
+        if current_user.role == 'admin':
+            form = PairSpreadForm()
+            form.from_currency_id.choices = form.to_currency_id.choices = [(c.id, c.code) for c in Currency.query.all()]
+        spreads = PairSpread.query.order_by(PairSpread.from_currency_id, PairSpread.to_currency_id).all()
+        settings = Settings.query.first()
+        return render_template('quotes.html', codes=codes, matrix=zip(codes, matrix), form=form, spreads=spreads,
+                               default_spread=app.config.get('QUOTE_DEFAULT_SPREAD_BPS', 50.0), settings=settings)
+
+    @app.route('/quotes/spread', methods=['POST'])
+    @require_admin_permission
+    def spread_save():
+        form = PairSpreadForm()
+        form.from_currency_id.choices = form.to_currency_id.choices = [(c.id, c.code) for c in Currency.query.all()]
+        if not form.validate_on_submit() or form.from_currency_id.data == form.to_currency_id.data:
+            flash('بيانات الهامش غير صالحة')
+            return redirect(url_for('quotes_view'))
+        spread = PairSpread.query.filter_by(from_currency_id=form.from_currency_id.data,
+                                            to_currency_id=form.to_currency_id.data).first()
+        if spread is None:
+            spread = PairSpread(from_currency_id=form.from_currency_id.data, to_currency_id=form.to_currency_id.data)
+            db.session.add(spread)
+        spread.spread_bps = form.spread_bps.data
+        db.session.commit()
+        quotes.engine.rebuild()
+        flash('تم حفظ الهامش')
+        return redirect(url_for('quotes_view'))
+
+    @app.route('/quotes/spread/delete/<int:id>', methods=['POST'])
+    @require_admin_permission
+    def spread_delete(id):
+        db.session.delete(PairSpread.query.get_or_404(id))
+        db.session.commit()
+        quotes.engine.rebuild()
+        flash('تم حذف الهامش وتطبيق الهامش الافتراضي')
+        return redirect(url_for('quotes_view'))
+
     # ----------------------------------------------------------------------
     # 9. مسارات إدارة العمليات وصندوق النقد (Transaction and Cashbox Routes)
     # ----------------------------------------------------------------------
@@ -301,7 +452,7 @@ def create_app():
     @app.route('/transactions')
     @require_general_permission
     def transactions():
-        txs = Transaction.query.order_by(Transaction.date.desc()).all()
+        txs = apply_scope(Transaction.query, Transaction, user_branch_id()).order_by(Transaction.date.desc()).all()
         settings = Settings.query.first()
         return render_template('transactions.html', transactions=txs, settings=settings)
 
@@ -313,6 +464,10 @@ def create_app():
         settings = Settings.query.first()
         
         if form.validate_on_submit():
+            if is_day_closed(datetime.utcnow()):
+                flash('تم إقفال اليوم الحالي ولا يمكن تسجيل عمليات جديدة')
+                return redirect(url_for('transactions'))
+
             c = Currency.query.get(form.currency_id.data)
             qty = form.quantity.data or 0
             buy_r = form.buy_rate.data or (c.rate if c else 0)
@@ -322,6 +477,8 @@ def create_app():
             total_local = (sell_r if form.type.data=='sell' else buy_r) * qty
             profit = (sell_r - buy_r) * qty if (sell_r and buy_r) else 0
             
+            branch_id = posting_branch_id()
+
             # Create Transaction
             tx = Transaction(
                 type=form.type.data,
@@ -331,25 +488,20 @@ def create_app():
                 sell_rate=sell_r,
                 total_value_local=total_local,
                 profit=profit,
-                notes=form.notes.data
+                notes=form.notes.data,
+                branch_id=branch_id
             )
             db.session.add(tx)
             
-            # Update Cashbox
-            last = Cashbox.query.filter_by(currency_id=c.id).order_by(Cashbox.date.desc()).first() if c else None
-            prev = last.balance_after if last else 0
-            
+            # Update Cashbox (each branch keeps its own running ledger; the
+            # balance is computed inside the INSERT so concurrent posts can't race)
             inflow = total_local if form.type.data=='sell' else 0
             outflow = total_local if form.type.data=='buy' else 0
-            new_balance = prev + inflow - outflow
-            
-            cb = Cashbox(
-                currency_id=c.id,
-                inflow=inflow,
-                outflow=outflow,
-                balance_after=new_balance
-            )
-            db.session.add(cb)
+            db.session.flush()
+            post_cashbox(c.id, branch_id, inflow=inflow, outflow=outflow, transaction_id=tx.id)
+
+            # Update the currency position (cost basis and realized P&L)
+            record_transaction(tx)
             
             db.session.commit()
             flash('تم تسجيل العملية')
@@ -361,14 +513,20 @@ def create_app():
     @require_editor_permission
     def transaction_edit(id):
         tx = Transaction.query.get_or_404(id)
+        check_branch_access(tx)
         form = TransactionForm(obj=tx)
         form.currency_id.choices = [(c.id, f"{c.code} - {c.name}") for c in Currency.query.all()]
         settings = Settings.query.first()
         
+        if is_day_closed(tx.date):
+            flash('لا يمكن تعديل عملية في يوم مُقفل')
+            return redirect(url_for('transactions'))
+
         if form.validate_on_submit():
             # Store old values for cashbox adjustment
             old_total_local = tx.total_value_local
             old_type = tx.type
+            old_currency_id = tx.currency_id
             
             # Update transaction object before recalculating
             tx.type = form.type.data
@@ -388,32 +546,24 @@ def create_app():
             tx.total_value_local = new_total_local
             tx.profit = (sell_r - buy_r) * tx.quantity if (sell_r and buy_r) else 0
             
-            # Cashbox adjustment logic (needs refinement for previous cashbox entries)
-            # NOTE: The provided cashbox update logic in the original code for 'edit' is fundamentally flawed
-            # because it only modifies the *latest* cashbox entry regardless of the transaction date.
-            # A proper fix would require recalculating all subsequent cashbox entries.
-            # For this context, I'll keep the original flawed logic but simplify the calculation:
-            
-            cashbox_entry = Cashbox.query.filter_by(currency_id=c.id).order_by(Cashbox.date.desc()).first()
-            if cashbox_entry:
-                # Calculate the net difference
-                old_flow = old_total_local * (1 if old_type == 'sell' else -1)
-                new_flow = new_total_local * (1 if tx.type == 'sell' else -1)
-                net_change = new_flow - old_flow
-                
-                # Update the latest balance
-                cashbox_entry.balance_after += net_change
-
-                # Note: Correctly updating inflow/outflow fields of the LATEST cashbox entry 
-                # (which is not necessarily the entry for this transaction) is complex and misleading. 
-                # A robust system would create a new cashbox entry or re-calculate subsequent ones.
-                # Sticking to the original flawed logic for fields update for stability:
-                if tx.type == 'sell':
-                    cashbox_entry.inflow = cashbox_entry.inflow - (old_total_local if old_type == 'sell' else 0) + new_total_local
-                else:
-                    cashbox_entry.outflow = cashbox_entry.outflow - (old_total_local if old_type == 'buy' else 0) + new_total_local
+            # Correct this transaction's own cashbox row; later balances are re-chained
+            try:
+                repost_source((old_currency_id, tx.branch_id, *transaction_flows(old_type, old_total_local)),
+                              (tx.currency_id, tx.branch_id, *transaction_flows(tx.type, new_total_local)),
+                              transaction_id=tx.id)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e))
+                return redirect(url_for('transactions'))
+
+            # Replay the affected position(s) from this transaction onward
+            db.session.flush()
+            recompute_from(tx.branch_id, old_currency_id, tx.date, tx.id)
+            if tx.currency_id != old_currency_id:
+                recompute_from(tx.branch_id, tx.currency_id, tx.date, tx.id)
                 
             db.session.commit()
+            analytics.columns.invalidate()
             flash('تم تحديث العملية')
             return redirect(url_for('transactions'))
             
@@ -426,32 +576,32 @@ def create_app():
     @require_editor_permission
     def transaction_delete(id):
         tx = Transaction.query.get_or_404(id)
+        check_branch_access(tx)
+        if is_day_closed(tx.date):
+            flash('لا يمكن حذف عملية في يوم مُقفل')
+            return redirect(url_for('transactions'))
         
-        # Adjust cashbox balance (reversing the effect of the deleted transaction)
-        cashbox_entry = Cashbox.query.filter_by(currency_id=tx.currency_id).order_by(Cashbox.date.desc()).first()
-        if cashbox_entry:
-            # Reversing the change is the opposite of the change:
-            # Buy (outflow) added -negative- to cash. Reverse is to add it back.
-            # Sell (inflow) added -positive- to cash. Reverse is to subtract it.
-            
-            change_amount = tx.total_value_local * (1 if tx.type == 'sell' else -1)
-            cashbox_entry.balance_after -= change_amount
-            
-            # Adjust latest inflow/outflow (flawed, as noted above, but kept for consistency)
-            if tx.type == 'sell':
-                cashbox_entry.inflow -= tx.total_value_local
-            else:
-                cashbox_entry.outflow -= tx.total_value_local
+        # Remove the transaction's cashbox movement and re-chain the later balances
+        try:
+            repost_source((tx.currency_id, tx.branch_id, *transaction_flows(tx.type, tx.total_value_local)), None,
+                          transaction_id=tx.id)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for('transactions'))
 
         db.session.delete(tx)
+        db.session.flush()
+        recompute_from(tx.branch_id, tx.currency_id, tx.date, tx.id)
         db.session.commit()
+        analytics.columns.invalidate()
         flash('تم حذف العملية')
         return redirect(url_for('transactions'))
 
     @app.route('/cashbox')
     @require_general_permission
     def cashbox_view():
-        rows = Cashbox.query.order_by(Cashbox.date.desc()).limit(200).all()
+        rows = apply_scope(Cashbox.query, Cashbox, user_branch_id()).order_by(Cashbox.date.desc()).limit(200).all()
         settings = Settings.query.first()
         return render_template('cashbox.html', rows=rows, settings=settings)
 
@@ -462,7 +612,7 @@ def create_app():
     @app.route('/expenses')
     @require_general_permission
     def expenses():
-        rows = Expense.query.order_by(Expense.date.desc()).all()
+        rows = apply_scope(Expense.query, Expense, user_branch_id()).order_by(Expense.date.desc()).all()
         settings = Settings.query.first()
         return render_template('expenses.html', rows=rows, settings=settings)
 
@@ -474,28 +624,25 @@ def create_app():
         settings = Settings.query.first()
         
         if form.validate_on_submit():
+            if is_day_closed(form.date.data or datetime.utcnow()):
+                flash('لا يمكن تسجيل مصروف في يوم مُقفل')
+                return render_template('expense_form.html', form=form, settings=settings)
+
             c = Currency.query.get(form.currency_id.data)
+            branch_id = posting_branch_id()
             e = Expense(
                 date=form.date.data,
                 category=form.category.data,
                 amount=form.amount.data or 0,
                 currency_id=form.currency_id.data,
-                notes=form.notes.data
+                notes=form.notes.data,
+                branch_id=branch_id
             )
             db.session.add(e)
             
-            # Update cashbox
-            last = Cashbox.query.filter_by(currency_id=c.id).order_by(Cashbox.date.desc()).first() if c else None
-            prev = last.balance_after if last else 0
-            new_balance = prev - e.amount # Expense is always an outflow
-            
-            cb = Cashbox(
-                currency_id=c.id,
-                outflow=e.amount,
-                inflow=0,
-                balance_after=new_balance
-            )
-            db.session.add(cb)
+            # Update cashbox (Expense is always an outflow)
+            db.session.flush()
+            post_cashbox(c.id, branch_id, outflow=e.amount, expense_id=e.id)
             
             db.session.commit()
             flash('تم تسجيل المصروف')
@@ -507,28 +654,36 @@ def create_app():
     @require_editor_permission
     def expense_edit(id):
         expense = Expense.query.get_or_404(id)
+        check_branch_access(expense)
         form = ExpenseForm(obj=expense)
         form.currency_id.choices = [(c.id, f"{c.code} - {c.name}") for c in Currency.query.all()]
         settings = Settings.query.first()
         
+        if is_day_closed(expense.date):
+            flash('لا يمكن تعديل مصروف في يوم مُقفل')
+            return redirect(url_for('expenses'))
+
         if form.validate_on_submit():
-            old_amount = expense.amount
-            
+            if is_day_closed(form.date.data):
+                flash('لا يمكن نقل المصروف إلى يوم مُقفل')
+                return render_template('expense_form.html', form=form, expense=expense, settings=settings)
+
+            old = (expense.currency_id, expense.branch_id, 0, expense.amount or 0)
+
             expense.date = form.date.data
             expense.category = form.category.data
             expense.amount = form.amount.data or 0
             expense.currency_id = form.currency_id.data
             expense.notes = form.notes.data
-            
-            # Adjust cashbox balance
-            cashbox_entry = Cashbox.query.filter_by(currency_id=expense.currency_id).order_by(Cashbox.date.desc()).first()
-            if cashbox_entry:
-                # expense is an outflow (negative flow). 
-                # Reversing old outflow means adding old_amount back (old_amount).
-                # Applying new outflow means subtracting new amount (-expense.amount).
-                cashbox_entry.outflow = cashbox_entry.outflow - old_amount + expense.amount
-                cashbox_entry.balance_after = cashbox_entry.balance_after + old_amount - expense.amount
-            
+
+            # Correct this expense's own cashbox row (always an outflow)
+            try:
+                repost_source(old, (expense.currency_id, expense.branch_id, 0, expense.amount), expense_id=expense.id)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e))
+                return redirect(url_for('expenses'))
+
             db.session.commit()
             flash('تم تحديث المصروف')
             return redirect(url_for('expenses'))
@@ -542,13 +697,19 @@ def create_app():
     @require_editor_permission
     def expense_delete(id):
         expense = Expense.query.get_or_404(id)
+        check_branch_access(expense)
+        if is_day_closed(expense.date):
+            flash('لا يمكن حذف مصروف في يوم مُقفل')
+            return redirect(url_for('expenses'))
         
-        # Adjust cashbox balance (reversing the outflow)
-        cashbox_entry = Cashbox.query.filter_by(currency_id=expense.currency_id).order_by(Cashbox.date.desc()).first()
-        if cashbox_entry:
-            cashbox_entry.outflow -= expense.amount
-            cashbox_entry.balance_after += expense.amount # Add the amount back to the balance
-            
+        # Remove the expense's cashbox movement and re-chain the later balances
+        try:
+            repost_source((expense.currency_id, expense.branch_id, 0, expense.amount or 0), None, expense_id=expense.id)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for('expenses'))
+
         db.session.delete(expense)
         db.session.commit()
         flash('تم حذف المصروف')
@@ -570,9 +731,31 @@ def create_app():
     @app.route('/debts')
     @require_general_permission
     def debts():
-        debts = Debt.query.order_by(Debt.date.desc()).all()
+        status = request.args.get('status', '')
+        person = request.args.get('person', '').strip()
+        q = apply_scope(Debt.query, Debt, user_branch_id())
+        if status == 'paid':
+            q = q.filter(Debt.is_paid == True)
+        elif status == 'unpaid':
+            q = q.filter(Debt.is_paid == False)
+        elif status == 'overdue':
+            q = q.filter(Debt.is_paid == False, Debt.due_date < datetime.utcnow().date())
+        if person:
+            q = q.filter(person_prefix(person))
+        debts = q.order_by(Debt.date.desc()).all()
+        settings = get_settings_or_default()
+        return render_template('debts.html', debts=debts, status=status, person=person, settings=settings)
+
+    @app.route('/debts/aging')
+    @require_general_permission
+    def debts_aging():
+        person = request.args.get('person', '').strip()
+        scope = user_branch_id()
+        aging = aging_report(datetime.utcnow().date(), branch_id=scope)
+        exposure = exposure_by_person(person=person or None, branch_id=scope)
         settings = get_settings_or_default()
-        return render_template('debts.html', debts=debts, settings=settings)
+        return render_template('debts_aging.html', aging=aging, buckets=AGING_BUCKETS,
+                               exposure=exposure, person=person, settings=settings)
 
     @app.route('/debt/add', methods=['GET','POST'])
     @require_editor_permission
@@ -597,7 +780,8 @@ def create_app():
                 currency_id=form.currency_id.data,
                 due_date=form.due_date.data,
                 notes=form.notes.data,
-                is_paid=form.is_paid.data if form.is_paid.data is not None else False
+                is_paid=form.is_paid.data if form.is_paid.data is not None else False,
+                branch_id=posting_branch_id()
             )
             db.session.add(d)
             db.session.commit()
@@ -610,6 +794,7 @@ def create_app():
     @require_editor_permission
     def debt_edit(id):
         debt = Debt.query.get_or_404(id)
+        check_branch_access(debt)
         form = DebtForm(obj=debt)
         currencies = Currency.query.all()
         
@@ -643,6 +828,7 @@ def create_app():
     @require_editor_permission
     def debt_delete(id):
         debt = Debt.query.get_or_404(id)
+        check_branch_access(debt)
         db.session.delete(debt)
         db.session.commit()
         flash('تم حذف الدين')
@@ -655,41 +841,38 @@ def create_app():
     @app.route('/reports')
     @require_general_permission
     def reports():
-        total_profit = db.session.query(db.func.coalesce(db.func.sum(Transaction.profit),0)).scalar() or 0
-        total_expenses = db.session.query(db.func.coalesce(db.func.sum(Expense.amount),0)).scalar() or 0
-        txs = Transaction.query.order_by(Transaction.date.desc()).all()
-        exps = Expense.query.order_by(Expense.date.desc()).all()
+        scope = user_branch_id()
+        total_profit = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Transaction.profit),0)), Transaction, scope).scalar() or 0
+        total_expenses = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Expense.amount),0)), Expense, scope).scalar() or 0
+        txs = apply_scope(Transaction.query, Transaction, scope).order_by(Transaction.date.desc()).all()
+        exps = apply_scope(Expense.query, Expense, scope).order_by(Expense.date.desc()).all()
         
-        balances = {}
-        for c in Currency.query.all():
-            last = Cashbox.query.filter_by(currency_id=c.id).order_by(Cashbox.date.desc()).first()
-            balances[c.code] = last.balance_after if last else 0
+        balances = latest_balances(scope)
+        summary = analytics.currency_summary(analytics.select(analytics.columns.get(), branch_id=scope))
             
         settings = Settings.query.first()
         return render_template('reports.html', total_profit=total_profit, total_expenses=total_expenses, 
-                               txs=txs, exps=exps, balances=balances, settings=settings)
+                               txs=txs, exps=exps, balances=balances, analytics=summary, settings=settings)
 
     @app.route('/reports/export/transactions.xlsx')
     @login_required
     def export_transactions():
-        txs = Transaction.query.order_by(Transaction.date.desc()).all()
+        txs = apply_scope(Transaction.query, Transaction, user_branch_id()).order_by(Transaction.date.desc()).all()
         return export_transactions_excel(txs)
 
     @app.route('/reports/export/expenses.xlsx')
     @login_required
     def export_expenses():
-        exps = Expense.query.order_by(Expense.date.desc()).all()
+        exps = apply_scope(Expense.query, Expense, user_branch_id()).order_by(Expense.date.desc()).all()
         return export_expenses_excel(exps)
 
     @app.route('/reports/export/summary.pdf')
     @login_required
     def export_summary_pdf():
-        total_profit = db.session.query(db.func.coalesce(db.func.sum(Transaction.profit),0)).scalar() or 0
-        total_expenses = db.session.query(db.func.coalesce(db.func.sum(Expense.amount),0)).scalar() or 0
-        balances = {}
-        for c in Currency.query.all():
-            last = Cashbox.query.filter_by(currency_id=c.id).order_by(Cashbox.date.desc()).first()
-            balances[c.code] = last.balance_after if last else 0
+        scope = user_branch_id()
+        total_profit = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Transaction.profit),0)), Transaction, scope).scalar() or 0
+        total_expenses = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Expense.amount),0)), Expense, scope).scalar() or 0
+        balances = latest_balances(scope)
             
         # The currency_fmt filter is available globally but not in render_template_string unless passed explicitly.
         # However, to use the filter for clean formatting, it's safer to format the values before passing them.
@@ -704,9 +887,78 @@ def create_app():
             balances=formatted_balances
         )
         return render_pdf_from_html(html)
+
+    @app.route('/reports/positions')
+    @require_general_permission
+    def reports_positions():
+        rows = positions_report(user_branch_id())
+        settings = Settings.query.first()
+        return render_template('positions.html', rows=rows, settings=settings)
+
+    @app.route('/reports/branches')
+    @require_general_permission
+    def reports_branches():
+        if user_branch_id() is not ALL_BRANCHES:
+            flash('التقرير الموحد متاح للإدارة العامة فقط')
+            return redirect(url_for('reports'))
+        report = consolidated_report(app)
+        settings = Settings.query.first()
+        return render_template('reports_branches.html', report=report, settings=settings)
     
     # ----------------------------------------------------------------------
-    # 13. مسارات واجهة برمجة التطبيقات (API Routes)
+    # 13. مسارات البحث (Search Routes)
+    # ----------------------------------------------------------------------
+
+    def search_params():
+        """يقرأ معايير البحث من الرابط: q, kind, currency, from, to."""
+        def parse_day(value):
+            try:
+                return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+            except ValueError:
+                return None
+        code = (request.args.get('currency') or '').upper()
+        currency = Currency.query.filter_by(code=code).first() if code else None
+        return {
+            'q': request.args.get('q', '').strip(),
+            'kind': request.args.get('kind') or None,
+            'currency_id': currency.id if currency else None,
+            'date_from': parse_day(request.args.get('from')),
+            'date_to': parse_day(request.args.get('to')),
+        }
+
+    @app.route('/search')
+    @require_general_permission
+    def search():
+        params = search_params()
+        results = search_index(**params, limit=100, branch_id=user_branch_id())
+        currencies = Currency.query.all()
+        settings = Settings.query.first()
+        return render_template('search.html', results=results, params=params, args=request.args,
+                               currencies=currencies, settings=settings)
+
+    # ----------------------------------------------------------------------
+    # 14. مسارات إقفال اليوم (End-of-Day Close Routes)
+    # ----------------------------------------------------------------------
+
+    @app.route('/close-day', methods=['GET', 'POST'])
+    @require_admin_permission
+    def close_day_view():
+        form = CloseDayForm()
+        settings = Settings.query.first()
+        if form.validate_on_submit():
+            try:
+                close_day(form.day.data, closed_by=current_user.username)
+                flash('تم إقفال اليوم بنجاح')
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e))
+            return redirect(url_for('close_day_view'))
+
+        closes = DailyClose.query.order_by(DailyClose.day.desc(), DailyClose.currency_id).limit(100).all()
+        return render_template('closes.html', form=form, closes=closes, settings=settings)
+
+    # ----------------------------------------------------------------------
+    # 15. مسارات واجهة برمجة التطبيقات (API Routes)
     # ----------------------------------------------------------------------
 
     @app.route('/api/user-info')
@@ -714,10 +966,201 @@ def create_app():
     def api_user_info():
         return jsonify({'username': current_user.username, 'role': current_user.role})
 
+    @app.route('/api/balance-as-of')
+    @login_required
+    def api_balance_as_of():
+        """رصيد الصندوق لعملة في نهاية يوم معين: ?currency=USD&date=2026-03-31"""
+        code = (request.args.get('currency') or '').upper()
+        currency = Currency.query.filter_by(code=code).first()
+        if not currency:
+            return jsonify({'error': 'unknown currency'}), 404
+        try:
+            day = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'date must be YYYY-MM-DD'}), 400
+        return jsonify({
+            'currency': currency.code,
+            'date': day.isoformat(),
+            'balance': balance_as_of(currency.id, day, branch_id=user_branch_id()),
+            'closed': is_day_closed(day),
+        })
+
+    @app.route('/api/search')
+    @login_required
+    def api_search():
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        return jsonify({'results': search_index(**search_params(), limit=limit, branch_id=user_branch_id())})
+
+    @app.route('/api/reports/branches')
+    @login_required
+    def api_reports_branches():
+        if user_branch_id() is not ALL_BRANCHES:
+            return jsonify({'error': 'head office only'}), 403
+        return jsonify(consolidated_report(app))
+
+    @app.route('/api/positions')
+    @login_required
+    def api_positions():
+        return jsonify({'method': app.config.get('COST_BASIS_METHOD', 'average'),
+                        'positions': positions_report(user_branch_id())})
+
+    @app.route('/api/analytics')
+    @login_required
+    def api_analytics():
+        """تحليلات العمليات: ?freq=day|hour&days=365&currency=USD"""
+        freq = 'hour' if request.args.get('freq') == 'hour' else 'day'
+        days = request.args.get('days', 365, type=int)
+        code = (request.args.get('currency') or '').upper()
+        currency = Currency.query.filter_by(code=code).first() if code else None
+        if code and not currency:
+            return jsonify({'error': 'unknown currency'}), 404
+        data = analytics.select(analytics.columns.get(), branch_id=user_branch_id(),
+                                currency_id=currency.id if currency else None,
+                                start=datetime.utcnow() - timedelta(days=days) if days > 0 else None)
+        return jsonify({
+            'freq': freq,
+            'series': analytics.volume_series(data, freq),
+            'summary': analytics.currency_summary(data),
+        })
+
+    def chart_response(payload, end):
+        """Compact JSON with an ETag; data for closed days no longer changes."""
+        resp = jsonify(payload)
+        closed = last_closed_day()
+        resp.cache_control.private = True
+        resp.cache_control.max_age = 86400 if closed and end.date() <= closed + timedelta(days=1) \
+            else app.config.get('CHART_CACHE_SECONDS', 60)
+        resp.add_etag()
+        return resp.make_conditional(request)
+
+    def chart_points():
+        return max(3, min(request.args.get('points', charts.DEFAULT_POINTS, type=int), charts.MAX_POINTS))
+
+    @app.route('/api/charts/flows')
+    @login_required
+    def api_chart_flows():
+        """الربح والمصاريف وحجم التداول لكل فترة: ?days=365&points=300&bucket=day|week|month"""
+        try:
+            start, end = charts.parse_range(request.args)
+        except ValueError:
+            return jsonify({'error': 'use start/end as YYYY-MM-DD or days as a number'}), 400
+        return chart_response(charts.flow_series(start, end, chart_points(), request.args.get('bucket'),
+                                                 branch_id=user_branch_id()), end)
+
+    @app.route('/api/charts/balances')
+    @login_required
+    def api_chart_balances():
+        """رصيد الصندوق اليومي لكل عملة: ?currency=USD,EUR&days=365&points=300"""
+        try:
+            start, end = charts.parse_range(request.args)
+        except ValueError:
+            return jsonify({'error': 'use start/end as YYYY-MM-DD or days as a number'}), 400
+        currencies, unknown = charts.chart_currencies(request.args.get('currency'))
+        if unknown:
+            return jsonify({'error': 'unknown currency', 'currencies': unknown}), 404
+        return chart_response(charts.balance_series(currencies, start, end, chart_points(),
+                                                    branch_id=user_branch_id()), end)
+
+    @app.route('/api/changes')
+    @login_required
+    def api_changes():
+        """سجل التغييرات بصيغة NDJSON بعد مؤشر معين: ?since=<seq>&limit=10000&tables=transaction,debt"""
+        since = request.args.get('since', 0, type=int)
+        limit = max(1, min(request.args.get('limit', 10000, type=int), 100000))
+        tables = [t for t in (request.args.get('tables') or '').split(',') if t] or None
+        # Stop at the sequence current at request time; X-Change-Seq tells the
+        # consumer whether it has caught up
+        until = latest_seq()
+        batches = iter_change_batches(since, until=until, tables=tables, branch_id=user_branch_id(), limit=limit)
+        resp = Response(stream_with_context(''.join(map(to_ndjson, batch)) for batch in batches),
+                        mimetype='application/x-ndjson')
+        resp.headers['X-Change-Seq'] = str(until)
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
+    @app.route('/api/quote')
+    @login_required
+    def api_quote():
+        """سعر تحويل واحد: ?from=EUR&to=USD&amount=100"""
+        try:
+            amount = float(request.args.get('amount', 1.0))
+        except ValueError:
+            amount = math.nan
+        if not math.isfinite(amount):
+            return jsonify({'error': 'amount must be a number'}), 400
+        try:
+            return jsonify(quotes.engine.quote(request.args.get('from', ''), request.args.get('to', ''), amount))
+        except quotes.QuoteError as e:
+            return jsonify({'error': str(e)}), 400
+
+    @app.route('/api/quotes', methods=['POST'])
+    @login_required
+    def api_quotes():
+        """أسعار تحويل متعددة: {"quotes": [{"from": "EUR", "to": "USD", "amount": 100}, ...]}"""
+        items = (request.get_json(silent=True) or {}).get('quotes')
+        if not isinstance(items, list) or len(items) > 10000:
+            return jsonify({'error': 'quotes must be a list of at most 10000 items'}), 400
+        try:
+            requests_ = [(q.get('from', ''), q.get('to', ''), float(q.get('amount', 1))) for q in items]
+            if not all(math.isfinite(a) for _, _, a in requests_):
+                raise ValueError
+        except (AttributeError, TypeError, ValueError):
+            return jsonify({'error': 'each quote needs from, to and a numeric amount'}), 400
+        return jsonify({'quotes': quotes.engine.quote_many(requests_)})
+
+    @app.route('/api/rates', methods=['POST'])
+    @require_editor_permission
+    def api_rates():
+        """تحديث أسعار عدة عملات دفعة واحدة: {"rates": {"USD": 1310, "EUR": 1420}}"""
+        rates = (request.get_json(silent=True) or {}).get('rates')
+        if not isinstance(rates, dict):
+            return jsonify({'error': 'rates must be an object of code -> rate'}), 400
+        by_code = {c.code: c for c in Currency.query.filter(Currency.code.in_([str(k).upper() for k in rates])).all()}
+        unknown = [k for k in rates if str(k).upper() not in by_code]
+        if unknown:
+            return jsonify({'error': 'unknown currencies', 'currencies': unknown}), 404
+        now = datetime.utcnow()
+        try:
+            for code, rate in rates.items():
+                rate = float(rate)
+                if not (math.isfinite(rate) and rate > 0):
+                    raise ValueError
+                c = by_code[str(code).upper()]
+                c.rate, c.last_update = rate, now
+        except (TypeError, ValueError):
+            db.session.rollback()
+            return jsonify({'error': 'rates must be positive numbers'}), 400
+        db.session.commit()
+        quotes.engine.rebuild()
+        return jsonify({'updated': len(rates)})
+
+    @app.route('/api/backups', methods=['GET', 'POST'])
+    @require_admin_permission
+    def api_backups():
+        """النسخ الاحتياطية: GET للقائمة والحالة، POST لبدء نسخة جديدة في الخلفية."""
+        if request.method == 'POST':
+            try:
+                started = backup.start_background(app)
+            except backup.BackupError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'started': started}), 202 if started else 409
+        last = backup.status['last']
+        return jsonify({
+            'running': backup.status['running'],
+            'error': backup.status['error'],
+            'last': {k: v for k, v in last.items() if k != 'path'} if last else None,
+            'backups': [{k: v for k, v in b.items() if k != 'path'} for b in backup.list_backups(app.config['BACKUP_DIR'])],
+        })
+
+    @app.route('/api/debts/overdue')
+    @login_required
+    def api_debts_overdue():
+        return jsonify(overdue_summary(datetime.utcnow().date(), branch_id=user_branch_id()))
+
     return app
 
 # ----------------------------------------------------------------------
-# 14. نقطة الدخول (Entry Point)
+# 16. نقطة الدخول (Entry Point)
 # ----------------------------------------------------------------------
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import urllib.request
+from flask import request, send_from_directory, abort
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are produced without it
+    brotli = None
+
+# Third-party files served from our own origin instead of the CDN. Paths are
+# relative to the static folder. The files are committed; build_assets.py
+# --fetch downloads them again after the pinned versions change.
+VENDOR = {
+    'vendor/bootstrap/bootstrap.rtl.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.8/dist/css/bootstrap.rtl.min.css',
+    'vendor/bootstrap/bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.8/dist/js/bootstrap.bundle.min.js',
+    'vendor/bootstrap-icons/bootstrap-icons.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.13.1/font/bootstrap-icons.min.css',
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff2': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.13.1/font/fonts/bootstrap-icons.woff2',
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.13.1/font/fonts/bootstrap-icons.woff',
+}
+
+# Bundle name -> source files in load order
+BUNDLES = {
+    'app.css': [
+        'vendor/bootstrap/bootstrap.rtl.min.css',
+        'vendor/bootstrap-icons/bootstrap-icons.min.css',
+        'css/styles.css',
+        'css/theme-extra.css',
+    ],
+    'app.js': [
+        'vendor/bootstrap/bootstrap.bundle.min.js',
+        'js/main.js',
+    ],
+}
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+URL_PREFIX = '/assets/'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json')
+MIN_COMPRESS_SIZE = 512
+
+
+def fetch_vendor(static_folder, force=False):
+    """Download vendored files that are not present yet. Returns the fetched paths."""
+    fetched = []
+    for rel, url in VENDOR.items():
+        path = os.path.join(static_folder, rel)
+        if os.path.exists(path) and not force:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as resp, open(path, 'wb') as out:
+            shutil.copyfileobj(resp, out)
+        fetched.append(rel)
+    return fetched
+
+
+def minify_css(css):
+    # Keep /*! licence */ comments, drop the rest, then collapse whitespace
+    css = re.sub(r'/\*(?!!).*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    # Conservative: drop whole-line // comments, indentation and blank lines.
+    # Inline comments and string contents are left untouched.
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+_IMPORT = re.compile(r'@import\s+(?:url\([^)]*\)|"[^"]*"|\'[^\']*\')[^;]*;')
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _hashed_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{_digest(data)}{ext}'
+
+
+def _write(dist, name, data):
+    with open(os.path.join(dist, name), 'wb') as f:
+        f.write(data)
+    if name.endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_SIZE:
+        with open(os.path.join(dist, name + '.gz'), 'wb') as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(os.path.join(dist, name + '.br'), 'wb') as f:
+                f.write(brotli.compress(data, quality=11))
+
+
+def _rewrite_urls(css, src_rel, static_folder, dist, copied):
+    """Copy files referenced by relative url() into dist under hashed names."""
+    base = os.path.dirname(src_rel)
+
+    def repl(m):
+        ref = m.group(2)
+        if re.match(r'^(data:|https?:|//|/)', ref):
+            return m.group(0)
+        path, _, suffix = ref.partition('?')
+        target = os.path.normpath(os.path.join(base, path))
+        if target not in copied:
+            with open(os.path.join(static_folder, target), 'rb') as f:
+                data = f.read()
+            copied[target] = _hashed_name(os.path.basename(target), data)
+            _write(dist, copied[target], data)
+        return f'url("{copied[target]}")'
+
+    return re.sub(r'url\((["\']?)([^)"\']+)\1\)', repl, css)
+
+
+def sources_digest(static_folder):
+    """Digest of every bundle source plus the files its CSS can reference, so
+    a manifest built from other sources is detected as stale."""
+    digest = hashlib.sha256()
+    rels = sorted({rel for sources in BUNDLES.values() for rel in sources} | set(VENDOR))
+    for rel in rels:
+        path = os.path.join(static_folder, rel)
+        digest.update(rel.encode('utf-8'))
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_manifest(static_folder):
+    """The built manifest, or None when it is missing or older than the sources."""
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('sources') != sources_digest(static_folder):
+        return None
+    return manifest['files']
+
+
+def build(static_folder):
+    """Bundle, minify, fingerprint and precompress BUNDLES into static/dist.
+
+    Returns the manifest {bundle name: hashed file name}.
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    os.makedirs(dist)
+
+    manifest, copied = {}, {}
+    for name, sources in BUNDLES.items():
+        parts, imports = [], []
+        for rel in sources:
+            with open(os.path.join(static_folder, rel), encoding='utf-8') as f:
+                content = f.read()
+            if name.endswith('.css'):
+                content = _rewrite_urls(content, rel, static_folder, dist, copied)
+                # @import is only valid at the top of a stylesheet, so hoist it
+                imports += _IMPORT.findall(content)
+                content = _IMPORT.sub('', content)
+                parts.append(content if rel.endswith('.min.css') else minify_css(content))
+            else:
+                parts.append(content if rel.endswith('.min.js') else minify_js(content))
+        sep = '\n' if name.endswith('.css') else ';\n'
+        data = sep.join(imports + parts).encode('utf-8')
+        manifest[name] = _hashed_name(name, data)
+        _write(dist, manifest[name], data)
+
+    with open(os.path.join(dist, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump({'sources': sources_digest(static_folder), 'files': manifest}, f, indent=2)
+    return manifest
+
+
+def init_app(app):
+    """Register the /assets route and the asset_urls() template helper.
+
+    static/dist is committed. When its manifest is missing or does not match
+    the sources (a stylesheet was edited without running build_assets.py) the
+    bundles are rebuilt here; on a read-only deploy the sources are served as
+    they are instead.
+    """
+    dist = os.path.join(app.static_folder, DIST_DIR)
+    manifest = load_manifest(app.static_folder)
+    if manifest is None:
+        try:
+            manifest = build(app.static_folder)
+        except OSError as e:
+            app.logger.warning('asset bundles not rebuilt: %s', e)
+            manifest = {}
+
+    def asset_urls(name):
+        """URLs to include for a bundle: the fingerprinted file once built,
+        otherwise its individual sources (CDN for vendor files not fetched yet)."""
+        if name in manifest:
+            return [URL_PREFIX + manifest[name]]
+        urls = []
+        for rel in BUNDLES[name]:
+            if rel in VENDOR and not os.path.exists(os.path.join(app.static_folder, rel)):
+                urls.append(VENDOR[rel])
+            else:
+                urls.append('/static/' + rel)
+        return urls
+
+    app.jinja_env.globals['asset_urls'] = asset_urls
+
+    @app.route(URL_PREFIX + '<path:filename>')
+    def assets(filename):
+        # Names are content hashes, so a response can be cached forever
+        if not os.path.isfile(os.path.join(dist, filename)):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+        for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[encoding] and os.path.isfile(os.path.join(dist, filename + ext)):
+                resp = send_from_directory(dist, filename + ext, mimetype=mimetype)
+                resp.headers['Content-Encoding'] = encoding
+                break
+        else:
+            resp = send_from_directory(dist, filename, mimetype=mimetype)
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
@@ -0,0 +1,255 @@
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from sqlalchemy.engine import make_url
+
+# Backups use SQLite's online backup API rather than copying database.db, so
+# a backup is a consistent database even while tellers are writing. Pages are
+# copied in small steps from a separate connection. In WAL mode that
+# connection holds one read transaction for the whole copy: writers are never
+# blocked by a reader, and the backup sees a single snapshot instead of
+# restarting every time another connection commits. In rollback-journal mode
+# a held read lock would block every writer, so the copy is done in one step.
+#
+# Each backup is gzip-compressed, written to a .partial file and renamed into
+# place, with a sha256sum-compatible .sha256 file next to it.
+
+PREFIX = 'backup-'
+SUFFIX = '.db.gz'
+NAME_FORMAT = '%Y%m%d-%H%M%S-%f'
+READ_SIZE = 1 << 20
+
+
+class BackupError(Exception):
+    pass
+
+
+_running = threading.Lock()
+status = {'running': False, 'last': None, 'error': None}
+
+
+def database_path(app):
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        raise BackupError('backups need a file-based SQLite database')
+    return os.path.abspath(url.database)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _copy(source, target, pages, pause):
+    """Online copy of `source` into the `target` connection; returns the number of steps."""
+    steps = [0]
+
+    def progress(status_, remaining, total):
+        steps[0] += 1
+        if pause:
+            time.sleep(pause)
+
+    wal = source.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal'
+    if wal:
+        # Pin one snapshot for the whole copy; see the note at the top
+        source.execute('BEGIN')
+        source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+    try:
+        source.backup(target, pages=pages if wal else -1, progress=progress)
+    finally:
+        if wal:
+            source.execute('COMMIT')
+    return steps[0]
+
+
+def create_backup(db_path, backup_dir, pages=256, pause=0.002, busy_timeout_ms=10000):
+    """Back up the live database into backup_dir. Returns a dict describing the new backup.
+
+    Raises BackupError when another backup is already running.
+    """
+    if not _running.acquire(blocking=False):
+        raise BackupError('a backup is already running')
+    try:
+        return _create_backup(db_path, backup_dir, pages, pause, busy_timeout_ms)
+    finally:
+        _running.release()
+
+
+def _create_backup(db_path, backup_dir, pages, pause, busy_timeout_ms):
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    name = f'{PREFIX}{now.strftime(NAME_FORMAT)}{SUFFIX}'
+    path = os.path.join(backup_dir, name)
+    fd, raw = tempfile.mkstemp(suffix='.db', dir=backup_dir)
+    os.close(fd)
+    try:
+        source = sqlite3.connect(db_path, timeout=busy_timeout_ms / 1000, isolation_level=None)
+        target = sqlite3.connect(raw)
+        try:
+            steps = _copy(source, target, pages, pause)
+            check = target.execute('PRAGMA quick_check').fetchone()[0]
+            # A backup of a WAL database is itself in WAL mode; make it a single file
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        if check != 'ok':
+            raise BackupError(f'backup copy failed its integrity check: {check}')
+        size = os.path.getsize(raw)
+        with open(raw, 'rb') as f, gzip.open(path + '.partial', 'wb', compresslevel=6) as out:
+            shutil.copyfileobj(f, out, READ_SIZE)
+    finally:
+        os.remove(raw)
+    os.replace(path + '.partial', path)
+    checksum = _sha256(path)
+    with open(path + '.sha256', 'w') as f:
+        f.write(f'{checksum}  {name}\n')
+    return {'file': name, 'path': path, 'created': now, 'db_size': size,
+            'size': os.path.getsize(path), 'sha256': checksum, 'steps': steps,
+            'seconds': time.perf_counter() - started}
+
+
+def list_backups(backup_dir):
+    """Backups in backup_dir, newest first."""
+    if not os.path.isdir(backup_dir):
+        return []
+    backups = []
+    for name in os.listdir(backup_dir):
+        if not (name.startswith(PREFIX) and name.endswith(SUFFIX)):
+            continue
+        try:
+            created = datetime.strptime(name[len(PREFIX):-len(SUFFIX)], NAME_FORMAT)
+        except ValueError:
+            continue
+        path = os.path.join(backup_dir, name)
+        backups.append({'file': name, 'path': path, 'created': created, 'size': os.path.getsize(path),
+                        'checksum': os.path.exists(path + '.sha256')})
+    return sorted(backups, key=lambda b: b['created'], reverse=True)
+
+
+def prune_backups(backup_dir, keep_last=7, keep_daily=30):
+    """Apply the retention policy; returns the names of the deleted backups.
+
+    The newest keep_last backups are kept, plus the newest backup of each of
+    the last keep_daily days that have one.
+    """
+    backups = list_backups(backup_dir)
+    keep = {b['file'] for b in backups[:keep_last]}
+    days = set()
+    for b in backups:
+        day = b['created'].date()
+        if day not in days and len(days) < keep_daily:
+            days.add(day)
+            keep.add(b['file'])
+    removed = []
+    for b in backups:
+        if b['file'] not in keep:
+            for path in (b['path'], b['path'] + '.sha256'):
+                if os.path.exists(path):
+                    os.remove(path)
+            removed.append(b['file'])
+    return removed
+
+
+def verify_backup(path, keep_file=None):
+    """Check the checksum and decompress the backup into a database that passes integrity_check.
+
+    Returns {'sha256', 'tables', 'db_size'}. With keep_file the verified
+    database is left at that path (used by restore). Raises BackupError.
+    """
+    if not os.path.exists(path):
+        raise BackupError(f'{path} does not exist')
+    checksum = _sha256(path)
+    try:
+        with open(path + '.sha256') as f:
+            expected = f.read().split()[0]
+    except (OSError, IndexError):
+        raise BackupError(f'{path} has no checksum file')
+    if checksum != expected:
+        raise BackupError(f'checksum mismatch: {checksum} != {expected}')
+
+    fd, raw = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(keep_file) if keep_file else None)
+    os.close(fd)
+    try:
+        try:
+            with gzip.open(path, 'rb') as f, open(raw, 'wb') as out:
+                shutil.copyfileobj(f, out, READ_SIZE)
+        except (OSError, EOFError) as e:
+            raise BackupError(f'cannot decompress backup: {e}')
+        conn = sqlite3.connect(raw)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            tables = conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            raise BackupError(f'backup is not a valid database: {e}')
+        finally:
+            conn.close()
+        if result != 'ok':
+            raise BackupError(f'integrity check failed: {result}')
+        info = {'sha256': checksum, 'tables': tables, 'db_size': os.path.getsize(raw)}
+        if keep_file:
+            os.replace(raw, keep_file)
+        return info
+    finally:
+        if os.path.exists(raw):
+            os.remove(raw)
+
+
+def restore_backup(path, db_path, backup_dir, busy_timeout_ms=10000):
+    """Verify a backup, back up the current database, then copy the backup over it.
+
+    The restore goes through the backup API into the live file, so open
+    connections see the restored data on their next transaction. Returns
+    (verify info, the safety backup taken first).
+    """
+    verified = os.path.join(backup_dir, '.restore.db')
+    info = verify_backup(path, keep_file=verified)
+    try:
+        safety = create_backup(db_path, backup_dir, pages=-1, busy_timeout_ms=busy_timeout_ms)
+        source = sqlite3.connect(verified)
+        target = sqlite3.connect(db_path, timeout=busy_timeout_ms / 1000)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        os.remove(verified)
+    return info, safety
+
+
+def start_background(app):
+    """Run a backup plus pruning in a daemon thread for the admin endpoint; False if one is running."""
+    args = (database_path(app), app.config['BACKUP_DIR'])
+    options = {'pages': app.config.get('BACKUP_PAGES_PER_STEP', 256),
+               'pause': app.config.get('BACKUP_STEP_PAUSE', 0.002),
+               'busy_timeout_ms': app.config.get('SQLITE_BUSY_TIMEOUT_MS', 10000)}
+
+    if not _running.acquire(blocking=False):
+        return False
+    status['running'] = True
+
+    def run():
+        try:
+            result = _create_backup(*args, **options)
+            prune_backups(args[1], app.config.get('BACKUP_KEEP_LAST', 7), app.config.get('BACKUP_KEEP_DAILY', 30))
+            status['last'], status['error'] = result, None
+        except (BackupError, OSError, sqlite3.Error) as e:
+            status['error'] = str(e)
+        finally:
+            status['running'] = False
+            _running.release()
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
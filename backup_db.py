@@ -0,0 +1,57 @@
+# backup_db.py
+# نسخ احتياطي لقاعدة البيانات أثناء العمل، مع التحقق والاستعادة وسياسة الاحتفاظ
+# python backup_db.py [create]            نسخة جديدة ثم تطبيق سياسة الاحتفاظ
+# python backup_db.py list
+# python backup_db.py verify FILE
+# python backup_db.py restore FILE --yes  (يأخذ نسخة من القاعدة الحالية أولاً)
+import argparse
+import os
+import sys
+from app import create_app
+from backup import BackupError, database_path, create_backup, list_backups, prune_backups, verify_backup, restore_backup
+
+parser = argparse.ArgumentParser(description='Online SQLite backups.')
+parser.add_argument('command', nargs='?', default='create', choices=('create', 'list', 'verify', 'restore'))
+parser.add_argument('file', nargs='?', help='backup file (for verify and restore)')
+parser.add_argument('--dir', help='backup directory (default BACKUP_DIR)')
+parser.add_argument('--yes', action='store_true', help='confirm a restore over the live database')
+args = parser.parse_args()
+
+app = create_app()
+config = app.config
+backup_dir = args.dir or config['BACKUP_DIR']
+
+
+def resolve(name):
+    if not name:
+        print("❌ A backup file is required")
+        sys.exit(2)
+    return name if os.path.exists(name) else os.path.join(backup_dir, name)
+
+
+try:
+    db_path = database_path(app)
+    if args.command == 'create':
+        result = create_backup(db_path, backup_dir, pages=config['BACKUP_PAGES_PER_STEP'],
+                               pause=config['BACKUP_STEP_PAUSE'], busy_timeout_ms=config['SQLITE_BUSY_TIMEOUT_MS'])
+        print(f"✅ {result['file']}: {result['db_size'] / 1e6:.1f} MB -> {result['size'] / 1e6:.1f} MB "
+              f"in {result['seconds']:.2f}s ({result['steps']} steps), sha256 {result['sha256'][:16]}…")
+        for name in prune_backups(backup_dir, config['BACKUP_KEEP_LAST'], config['BACKUP_KEEP_DAILY']):
+            print(f"   removed {name}")
+    elif args.command == 'list':
+        for b in list_backups(backup_dir):
+            print(f"{b['file']}  {b['size'] / 1e6:8.1f} MB  {'sha256' if b['checksum'] else 'NO CHECKSUM'}")
+    elif args.command == 'verify':
+        info = verify_backup(resolve(args.file))
+        print(f"✅ {args.file}: checksum ok, integrity ok, {info['tables']} tables, {info['db_size'] / 1e6:.1f} MB")
+    else:
+        path = resolve(args.file)
+        if not args.yes:
+            print(f"❌ Restoring replaces {db_path} with {path}; rerun with --yes")
+            sys.exit(2)
+        info, safety = restore_backup(path, db_path, backup_dir, busy_timeout_ms=config['SQLITE_BUSY_TIMEOUT_MS'])
+        print(f"   current database saved as {safety['file']}")
+        print(f"✅ Restored {args.file} ({info['tables']} tables) into {db_path}")
+except BackupError as e:
+    print(f"❌ {e}")
+    sys.exit(1)
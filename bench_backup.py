@@ -0,0 +1,87 @@
+# bench_backup.py
+# قياس أثر النسخ الاحتياطي أثناء العمل على زمن الكتابة في الصندوق (يعمل على قاعدة بيانات مؤقتة)
+# python bench_backup.py [rows] [writers]
+import os
+import sys
+import tempfile
+import threading
+import time
+import config
+
+tmp = tempfile.TemporaryDirectory()
+config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+config.BACKUP_DIR = os.path.join(tmp.name, 'backups')
+
+import numpy as np  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db, Currency, Cashbox  # noqa: E402
+from ledger import post_cashbox  # noqa: E402
+from backup import database_path, create_backup, verify_backup  # noqa: E402
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+WRITERS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+BASELINE_SECONDS = 2.0
+
+app = create_app()
+with app.app_context():
+    db.session.add(Currency(code='USD', name='USD', rate=1))
+    db.session.commit()
+    currency_id = Currency.query.first().id
+    batch = [{'currency_id': currency_id, 'inflow': 1.0, 'outflow': 0.0, 'balance_after': float(i + 1)}
+             for i in range(ROWS)]
+    db.session.execute(Cashbox.__table__.insert(), batch)
+    db.session.commit()
+db_path = database_path(app)
+
+
+def measure(action):
+    """Run `action` while WRITERS threads post and commit; returns (latencies, seconds, result)."""
+    latencies, stop = [], threading.Event()
+
+    def writer():
+        with app.app_context():
+            while not stop.is_set():
+                started = time.perf_counter()
+                post_cashbox(currency_id, None, inflow=1.0)
+                db.session.commit()
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=writer) for _ in range(WRITERS)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    del latencies[:]
+    started = time.perf_counter()
+    result = action()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for t in threads:
+        t.join()
+    return np.array(latencies) * 1000, elapsed, result
+
+
+def run_backup(pages):
+    return lambda: create_backup(db_path, config.BACKUP_DIR, pages=pages, pause=config.BACKUP_STEP_PAUSE)
+
+
+print(f"{ROWS:,} cashbox rows ({os.path.getsize(db_path) / 1e6:.1f} MB), {WRITERS} writer threads")
+print(f"{'scenario':<24}{'seconds':>8}{'writes/s':>10}{'p50 ms':>8}{'p95 ms':>8}{'p99 ms':>8}{'max ms':>8}")
+scenarios = [('no backup', lambda: time.sleep(BASELINE_SECONDS))]
+scenarios += [(f'backup, {pages} pages/step' if pages > 0 else 'backup, one step', run_backup(pages))
+              for pages in (-1, 1024, config.BACKUP_PAGES_PER_STEP, 16)]
+failed = False
+for name, action in scenarios:
+    lat, elapsed, result = measure(action)
+    p50, p95, p99 = np.percentile(lat, [50, 95, 99]) if len(lat) else (0, 0, 0)
+    print(f"{name:<24}{elapsed:>8.2f}{len(lat) / elapsed:>10.0f}{p50:>8.1f}{p95:>8.1f}{p99:>8.1f}"
+          f"{lat.max() if len(lat) else 0:>8.1f}")
+    if result:
+        info = verify_backup(result['path'])
+        if info['db_size'] != result['db_size']:
+            failed = True
+        print(f"   {result['file']}: {result['steps']} steps, {result['size'] / 1e6:.1f} MB compressed, verified")
+
+if failed:
+    print("❌ A backup did not verify")
+    sys.exit(1)
+print("✅ Every backup verified while writers kept posting")
@@ -0,0 +1,101 @@
+# bench_cashbox.py
+# اختبار ضغط لترحيل الصندوق من عدة خيوط: صحة الرصيد التراكمي وعدد العمليات في الثانية
+# python bench_cashbox.py [threads] [posts_per_thread]   (يعمل على قاعدة بيانات مؤقتة)
+import os
+import sys
+import tempfile
+import threading
+import time
+import config
+
+tmp = tempfile.TemporaryDirectory()
+config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp.name, 'stress.db')
+
+from app import create_app  # noqa: E402
+from models import db, Currency, Cashbox  # noqa: E402
+from branches import last_cashbox_entry  # noqa: E402
+from ledger import post_cashbox  # noqa: E402
+
+THREADS = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+POSTS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+CURRENCIES = 8
+
+app = create_app()
+with app.app_context():
+    for i in range(CURRENCIES):
+        db.session.add(Currency(code=f'C{i}', name=f'C{i}', rate=1))
+    db.session.commit()
+    currency_ids = [c.id for c in Currency.query.order_by(Currency.id)]
+
+
+def post_atomic(currency_id, amount):
+    post_cashbox(currency_id, None, inflow=amount)
+    db.session.commit()
+
+
+def post_naive(currency_id, amount):
+    # The old pattern: read the last balance, then insert on top of it
+    last = last_cashbox_entry(currency_id, None)
+    prev = last.balance_after if last else 0
+    db.session.add(Cashbox(currency_id=currency_id, inflow=amount, outflow=0, balance_after=prev + amount))
+    db.session.commit()
+
+
+def run(post, spread):
+    with app.app_context():
+        db.session.query(Cashbox).delete()
+        db.session.commit()
+    errors = []
+
+    def worker(n):
+        currency_id = currency_ids[n % CURRENCIES] if spread else currency_ids[0]
+        with app.app_context():
+            for k in range(POSTS):
+                try:
+                    post(currency_id, k % 7 + 1)
+                except Exception as e:  # lock timeouts count as failed posts
+                    db.session.rollback()
+                    errors.append(type(e).__name__)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    # Every row must equal the previous balance plus its own flow, and the
+    # final balance must equal the sum of all flows in that ledger.
+    broken = 0
+    with app.app_context():
+        for currency_id in currency_ids:
+            rows = (db.session.query(Cashbox.inflow, Cashbox.outflow, Cashbox.balance_after)
+                    .filter(Cashbox.currency_id == currency_id)
+                    .order_by(Cashbox.date, Cashbox.id).all())
+            prev = 0
+            for inflow, outflow, balance in rows:
+                if abs(prev + inflow - outflow - balance) > 1e-6:
+                    broken += 1
+                prev = balance
+            if rows and abs(rows[-1][2] - sum(i - o for i, o, _ in rows)) > 1e-6:
+                broken += 1
+    posted = THREADS * POSTS - len(errors)
+    return posted / elapsed, broken, len(errors)
+
+
+print(f"{THREADS} threads x {POSTS} posts")
+print(f"{'mode':<10}{'currencies':<14}{'posts/s':>10}{'broken':>8}{'errors':>8}")
+failed = False
+for name, post in (('atomic', post_atomic), ('naive', post_naive)):
+    for spread in (False, True):
+        rate, broken, errors = run(post, spread)
+        label = f'{CURRENCIES} (spread)' if spread else '1 (shared)'
+        print(f"{name:<10}{label:<14}{rate:>10.0f}{broken:>8}{errors:>8}")
+        if name == 'atomic' and (broken or errors):
+            failed = True
+
+if failed:
+    print("❌ Atomic posting produced an inconsistent ledger")
+    sys.exit(1)
+print("✅ Atomic posting kept every ledger consistent")
@@ -0,0 +1,64 @@
+# bench_pages.py
+# قياس حجم الصفحات المرسلة وزمن العرض قبل/بعد الضغط وتخزين أجزاء القوالب
+# python bench_pages.py [repeats]   (يستخدم قاعدة البيانات المهيأة في config.py)
+import sys
+import tempfile
+import time
+from jinja2 import FileSystemBytecodeCache
+from app import create_app
+
+PAGES = ['/', '/transactions', '/cashbox', '/expenses', '/debts', '/reports', '/currencies']
+REPEATS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+app = create_app()
+app.config['WTF_CSRF_ENABLED'] = False
+client = app.test_client()
+if client.post('/login', data={'username': 'admin', 'password': 'admin123'}).status_code != 302:
+    print("❌ Login as admin/admin123 failed; run init_db.py first")
+    sys.exit(1)
+
+
+def measure(compress, fragments, encoding):
+    app.config['COMPRESS_ENABLED'] = compress
+    app.jinja_env.fragment_cache_enabled = fragments
+    app.jinja_env.fragment_cache.clear()
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    results = {}
+    for path in PAGES:
+        client.get(path, headers=headers)  # warm-up
+        started = time.perf_counter()
+        for _ in range(REPEATS):
+            resp = client.get(path, headers=headers)
+        results[path] = ((time.perf_counter() - started) / REPEATS * 1000, len(resp.data))
+    return results
+
+
+before = measure(False, False, None)
+after_gzip = measure(True, True, 'gzip')
+after_br = measure(True, True, 'br, gzip')
+
+print(f"{'page':<14}{'before ms':>10}{'after ms':>10}{'before B':>11}{'gzip B':>10}{'br B':>10}")
+total = [0, 0, 0]
+for path in PAGES:
+    ms0, b0 = before[path]
+    ms1, b1 = after_gzip[path]
+    _, b2 = after_br[path]
+    total = [total[0] + b0, total[1] + b1, total[2] + b2]
+    print(f"{path:<14}{ms0:>10.2f}{ms1:>10.2f}{b0:>11,}{b1:>10,}{b2:>10,}")
+print(f"{'total':<34}{total[0]:>11,}{total[1]:>10,}{total[2]:>10,}")
+
+
+# Cold template compilation: no bytecode cache vs a warm on-disk cache
+def compile_all(cache):
+    env = app.jinja_env.overlay(bytecode_cache=cache, cache_size=0)
+    started = time.perf_counter()
+    for name in env.list_templates():
+        env.get_template(name)
+    return (time.perf_counter() - started) * 1000
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    cold = compile_all(None)
+    compile_all(FileSystemBytecodeCache(tmp))
+    warm = compile_all(FileSystemBytecodeCache(tmp))
+print(f"✅ Template load: {cold:.1f} ms compiled, {warm:.1f} ms from bytecode cache")
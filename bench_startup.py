@@ -0,0 +1,51 @@
+# bench_startup.py
+# قياس زمن استيراد التطبيق عند الإقلاع البارد باستخدام python -X importtime
+# python bench_startup.py [budget_ms] [runs]   يفشل (exit 1) إذا تجاوز الزمن الحد أو حُمّلت مكتبات التصدير مبكراً
+import os
+import subprocess
+import sys
+
+BUDGET_MS = float(sys.argv[1]) if len(sys.argv) > 1 else float(os.environ.get('STARTUP_BUDGET_MS', 1000))
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+# Must only be imported on first export, never at startup
+LAZY_MODULES = ('pandas', 'xhtml2pdf', 'reportlab', 'xlsxwriter')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_times():
+    """{module: (self_us, cumulative_us, depth)} for one cold `import app`."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                          cwd=ROOT, capture_output=True, text=True, env=dict(os.environ, PRELOAD_EXPORTS='0'))
+    if proc.returncode != 0:
+        print(proc.stderr)
+        sys.exit(proc.returncode)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative), (len(name) - len(name.lstrip()) - 1) // 2)
+    return times
+
+
+runs = [import_times() for _ in range(RUNS)]
+best = min(runs, key=lambda t: t['app'][1])
+total_ms = best['app'][1] / 1000
+
+print(f"{'module':<28}{'cumulative ms':>14}")
+direct = sorted(((name, t[1]) for name, t in best.items() if t[2] == 1), key=lambda x: -x[1])
+for name, cumulative in direct[:10]:
+    print(f"{name:<28}{cumulative / 1000:>14.1f}")
+
+failed = False
+eager = sorted({name.split('.')[0] for name in best if name.split('.')[0] in LAZY_MODULES})
+if eager:
+    print(f"❌ Imported at startup: {', '.join(eager)}")
+    failed = True
+if total_ms > BUDGET_MS:
+    print(f"❌ import app: {total_ms:.0f} ms (best of {RUNS}) exceeds budget of {BUDGET_MS:.0f} ms")
+    failed = True
+if failed:
+    sys.exit(1)
+print(f"✅ import app: {total_ms:.0f} ms (best of {RUNS}), budget {BUDGET_MS:.0f} ms")
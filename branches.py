@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask_login import current_user
+from models import db, Branch, Currency, Transaction, Cashbox, Expense, Debt
+
+# Passed as branch_id to mean "every branch, consolidated". A branch_id of None
+# is the head-office ledger (rows posted by users without a branch).
+ALL_BRANCHES = object()
+
+HEAD_OFFICE_NAME = 'الإدارة العامة'
+
+
+def user_branch_id():
+    """The branch the current user is limited to, or ALL_BRANCHES for head office users."""
+    if current_user and current_user.is_authenticated and current_user.branch_id is not None:
+        return current_user.branch_id
+    return ALL_BRANCHES
+
+
+def posting_branch_id():
+    """Branch that new records of the current user are booked to (None = head office)."""
+    return current_user.branch_id if current_user and current_user.is_authenticated else None
+
+
+def all_branch_ids():
+    """Every ledger: head office (None) followed by each branch id."""
+    return [None] + [bid for (bid,) in db.session.query(Branch.id).order_by(Branch.id)]
+
+
+def apply_scope(query, model, branch_id=ALL_BRANCHES):
+    """Limit a query to one branch ledger; `== None` compiles to IS NULL for head office."""
+    if branch_id is ALL_BRANCHES:
+        return query
+    return query.filter(model.branch_id == branch_id)
+
+
+def last_cashbox_entry(currency_id, branch_id):
+    """Newest cashbox row of one branch ledger for a currency."""
+    return (Cashbox.query
+            .filter(Cashbox.currency_id == currency_id, Cashbox.branch_id == branch_id)
+            .order_by(Cashbox.date.desc(), Cashbox.id.desc())
+            .first())
+
+
+def latest_balances(branch_id=ALL_BRANCHES):
+    """Current cashbox balance per currency code, in one grouped query.
+
+    Every branch keeps its own running ledger, so the consolidated balance is
+    the sum of each branch's newest balance_after.
+    """
+    rn = db.func.row_number().over(
+        partition_by=(Cashbox.branch_id, Cashbox.currency_id),
+        order_by=(Cashbox.date.desc(), Cashbox.id.desc()),
+    ).label('rn')
+    latest = apply_scope(db.session.query(Cashbox.currency_id, Cashbox.balance_after, rn), Cashbox, branch_id).subquery()
+    rows = (db.session.query(Currency.code, db.func.coalesce(db.func.sum(latest.c.balance_after), 0))
+            .outerjoin(latest, db.and_(latest.c.currency_id == Currency.id, latest.c.rn == 1))
+            .group_by(Currency.id, Currency.code)
+            .order_by(Currency.id)
+            .all())
+    return {code: balance for code, balance in rows}
+
+
+def branch_summary(branch_id):
+    """Aggregates for one branch ledger (None = head office)."""
+    profit, tx_count = apply_scope(db.session.query(
+        db.func.coalesce(db.func.sum(Transaction.profit), 0), db.func.count(Transaction.id)), Transaction, branch_id).one()
+    expenses = apply_scope(db.session.query(db.func.coalesce(db.func.sum(Expense.amount), 0)), Expense, branch_id).scalar()
+    open_debts = dict(apply_scope(db.session.query(Currency.code, db.func.sum(Debt.amount))
+                                  .join(Currency, Currency.id == Debt.currency_id)
+                                  .filter(Debt.is_paid == False), Debt, branch_id)  # noqa: E712
+                      .group_by(Currency.code).all())
+    return {
+        'branch_id': branch_id,
+        'profit': profit,
+        'expenses': expenses,
+        'net': profit - expenses,
+        'transactions': tx_count,
+        'balances': latest_balances(branch_id),
+        'open_debts': open_debts,
+    }
+
+
+def consolidated_report(app, max_workers=8):
+    """Compute every branch's summary concurrently and merge them.
+
+    Each worker runs in its own app context and therefore its own session and
+    connection, so branches are aggregated in parallel rather than one by one.
+    """
+    branches = [(None, HEAD_OFFICE_NAME)] + [(b.id, b.name) for b in Branch.query.order_by(Branch.name).all()]
+
+    def work(branch_id):
+        with app.app_context():
+            return branch_summary(branch_id)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(branches)))) as pool:
+        summaries = list(pool.map(work, [bid for bid, _ in branches]))
+
+    total = {'profit': 0, 'expenses': 0, 'net': 0, 'transactions': 0, 'balances': {}, 'open_debts': {}}
+    for (_, name), summary in zip(branches, summaries):
+        summary['name'] = name
+        for key in ('profit', 'expenses', 'net', 'transactions'):
+            total[key] += summary[key]
+        for key in ('balances', 'open_debts'):
+            for code, value in summary[key].items():
+                total[key][code] = total[key].get(code, 0) + (value or 0)
+    return {'branches': summaries, 'total': total}
@@ -0,0 +1,27 @@
+# build_assets.py
+# بناء ملفات CSS/JS المجمعة والمضغوطة: python build_assets.py [--fetch]
+# --fetch يعيد تنزيل ملفات Bootstrap المثبتة الإصدار إلى static/vendor (بعد تغيير الإصدار في assets.py)
+import os
+import sys
+import assets
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+try:
+    fetched = assets.fetch_vendor(STATIC, force='--fetch' in sys.argv)
+except OSError as e:
+    print(f"❌ Could not download vendor files: {e}")
+    sys.exit(1)
+for rel in fetched:
+    print(f"⬇️  {rel}")
+
+manifest = assets.build(STATIC)
+dist = os.path.join(STATIC, assets.DIST_DIR)
+for name, hashed in manifest.items():
+    sizes = [f"{os.path.getsize(os.path.join(dist, hashed)):,} B"]
+    for ext in ('.gz', '.br'):
+        if os.path.exists(os.path.join(dist, hashed + ext)):
+            sizes.append(f"{ext[1:]} {os.path.getsize(os.path.join(dist, hashed + ext)):,} B")
+    print(f"✅ {name} -> {hashed} ({', '.join(sizes)})")
+if assets.brotli is None:
+    print("ℹ️  brotli not installed; only gzip variants were written")
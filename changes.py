@@ -0,0 +1,108 @@
+from sqlalchemy import text
+from models import db, Transaction, Expense, Cashbox, Currency, Debt
+from branches import ALL_BRANCHES
+
+# Triggers append one change_log row per insert, update and delete on the
+# synced tables, carrying a JSON image of the row. Like the search index they
+# run inside the writing statement, so changes made through raw SQL (such as
+# the atomic cashbox posts) are captured too. seq is AUTOINCREMENT, so a
+# consumer can always resume from the last seq it has applied.
+MODELS = {'transaction': Transaction, 'expense': Expense, 'cashbox': Cashbox, 'currency': Currency, 'debt': Debt}
+OPS = {'insert': ('I', 'new'), 'update': ('U', 'new'), 'delete': ('D', 'old')}
+
+# Rows without a branch (currencies) are visible to every consumer
+GLOBAL_TABLES = ('currency',)
+
+BATCH_SIZE = 1000
+
+
+def _table(name):
+    return MODELS[name].__table__.name
+
+
+def _row_json(ref, model):
+    pairs = ', '.join(f"'{c.name}', {ref}.\"{c.name}\"" for c in model.__table__.columns)
+    return f"json_object({pairs})"
+
+
+def _log_values(name, op, ref):
+    model = MODELS[name]
+    branch = f'{ref}.branch_id' if 'branch_id' in model.__table__.columns else 'NULL'
+    return (f"'{name}', {ref}.id, '{op}', strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), {branch}, "
+            f"{_row_json(ref, model)}")
+
+
+def _ddl():
+    statements = []
+    for name in MODELS:
+        for event, (op, ref) in OPS.items():
+            statements.append(
+                f'CREATE TRIGGER changes_{name}_{op.lower()} AFTER {event.upper()} ON "{_table(name)}" BEGIN '
+                f"INSERT INTO change_log(table_name, row_id, op, changed_at, branch_id, data) "
+                f"VALUES ({_log_values(name, op, ref)}); END")
+    return statements
+
+
+def ensure_change_log():
+    """(Re)create the change triggers so row images follow the current columns.
+
+    On first creation the existing rows are logged as inserts, so a consumer
+    starting from seq 0 gets a full snapshot.
+    """
+    with db.engine.connect() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'changes_%'")).first()
+    with db.engine.begin() as conn:
+        for name in MODELS:
+            for op, _ in OPS.values():
+                conn.execute(text(f"DROP TRIGGER IF EXISTS changes_{name}_{op.lower()}"))
+        for stmt in _ddl():
+            conn.execute(text(stmt))
+        if not exists:
+            for name in MODELS:
+                conn.execute(text(
+                    f"INSERT INTO change_log(table_name, row_id, op, changed_at, branch_id, data) "
+                    f"SELECT {_log_values(name, 'I', 's')} FROM \"{_table(name)}\" AS s ORDER BY s.id"))
+
+
+def latest_seq():
+    return db.session.execute(text("SELECT coalesce(max(seq), 0) FROM change_log")).scalar()
+
+
+def iter_change_batches(since=0, until=None, tables=None, branch_id=ALL_BRANCHES, limit=None):
+    """Yield lists of (seq, table, op, row_id, changed_at, data_json) after `since`, oldest first.
+
+    Rows are read in keyset batches on seq so a long feed never holds one big
+    result set. A branch-scoped consumer sees its own branch plus global tables.
+    """
+    sql = ["SELECT seq, table_name, op, row_id, changed_at, data FROM change_log WHERE seq > :after"]
+    params = {}
+    if until is not None:
+        sql.append("AND seq <= :until")
+        params['until'] = until
+    if tables:
+        names = [t for t in tables if t in MODELS]
+        sql.append("AND table_name IN (%s)" % ', '.join(f"'{t}'" for t in names) if names else "AND 0")
+    if branch_id is not ALL_BRANCHES:
+        sql.append("AND (branch_id IS :branch_id OR table_name IN (%s))" % ', '.join(f"'{t}'" for t in GLOBAL_TABLES))
+        params['branch_id'] = branch_id
+    sql.append("ORDER BY seq LIMIT :batch")
+    query = text(' '.join(sql))
+
+    after, sent = since, 0
+    while limit is None or sent < limit:
+        batch = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - sent)
+        rows = db.session.execute(query, dict(params, after=after, batch=batch)).all()
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+        sent += len(rows)
+        after = rows[-1][0]
+        if len(rows) < batch:
+            return
+
+
+def to_ndjson(change):
+    """One compact NDJSON line; the stored row JSON is embedded as-is."""
+    seq, table, op, row_id, changed_at, data = change
+    return f'{{"seq":{seq},"table":"{table}","op":"{op}","id":{row_id},"at":"{changed_at}","row":{data or "null"}}}\n'
@@ -0,0 +1,252 @@
+from collections import defaultdict
+from datetime import datetime, date, timedelta, timezone
+import numpy as np
+from models import db, Currency, Transaction, Expense, Cashbox, DailyClose
+from branches import ALL_BRANCHES, all_branch_ids, apply_scope
+from closing import balance_as_of
+
+# Chart data never leaves the database as raw rows. Flows (profit, expenses,
+# volume) are summed per calendar bucket in SQL, with the bucket chosen so a
+# range fits in the requested number of points; when even monthly buckets are
+# too many, neighbouring buckets are merged so totals are preserved. Balances
+# are levels, not sums: closed days come straight from the DailyClose
+# checkpoints, open days from the last cashbox row of each day, and long
+# series are reduced with Largest-Triangle-Three-Buckets, which keeps the
+# peaks and troughs a plain stride would drop.
+#
+# Timestamps are epoch seconds of the bucket start (UTC), as in analytics.
+
+BUCKETS = ('day', 'week', 'month')
+DEFAULT_POINTS = 300
+MAX_POINTS = 2000
+
+
+def _bucket_start(column, bucket):
+    if bucket == 'week':
+        day = db.func.date(column, 'weekday 0', '-6 days')  # Monday
+    elif bucket == 'month':
+        day = db.func.strftime('%Y-%m-01', column)
+    else:
+        day = db.func.date(column)
+    return db.cast(db.func.strftime('%s', day), db.Integer)
+
+
+def pick_bucket(start, end, points):
+    """The finest calendar bucket that fits [start, end) into `points` buckets."""
+    days = max((end - start).days, 1)
+    if days <= points:
+        return 'day'
+    if days / 7 <= points:
+        return 'week'
+    return 'month'
+
+
+def parse_range(args, default_days=365):
+    """[start, end) datetimes from ?start=&end= (YYYY-MM-DD) or ?days=. Raises ValueError."""
+    today = datetime.utcnow().date()
+    end = datetime.strptime(args['end'], '%Y-%m-%d').date() if args.get('end') else today
+    if args.get('start'):
+        start = datetime.strptime(args['start'], '%Y-%m-%d').date()
+    else:
+        start = end - timedelta(days=max(int(args.get('days', default_days)), 1) - 1)
+    if start > end:
+        raise ValueError('start is after end')
+    return datetime.combine(start, datetime.min.time()), datetime.combine(end + timedelta(days=1), datetime.min.time())
+
+
+def lttb(x, y, threshold):
+    """Indices of the `threshold` points Largest-Triangle-Three-Buckets keeps.
+
+    The first and last points are always kept; every bucket in between keeps
+    the point forming the largest triangle with the point kept before it and
+    the average of the next bucket.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.floor(np.linspace(1, n - 1, threshold - 1)).astype(np.int64)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def _merge_buckets(columns, points):
+    """Sum runs of neighbouring buckets so at most `points` remain; t keeps each run's start."""
+    n = len(columns['t'])
+    if n <= points:
+        return columns
+    starts = np.unique(np.floor(np.linspace(0, n, points, endpoint=False)).astype(np.int64))
+    merged = {k: np.add.reduceat(v, starts) for k, v in columns.items() if k != 't'}
+    merged['t'] = columns['t'][starts]
+    return merged
+
+
+def _sums(query, column, bucket, start, end, *values):
+    t = _bucket_start(column, bucket).label('t')
+    rows = (query(t, *values)
+            .filter(column >= start, column < end)
+            .group_by(t).order_by(t).all())
+    return {int(r[0]): r[1:] for r in rows}
+
+
+def flow_series(start, end, points=DEFAULT_POINTS, bucket=None, branch_id=ALL_BRANCHES):
+    """Profit, expenses, net profit, traded volume and trade count per bucket, as columns."""
+    bucket = bucket if bucket in BUCKETS else pick_bucket(start, end, points)
+
+    def scoped(model):
+        return lambda *cols: apply_scope(db.session.query(*cols), model, branch_id)
+
+    trades = _sums(scoped(Transaction), Transaction.date, bucket, start, end,
+                   db.func.coalesce(db.func.sum(Transaction.profit), 0),
+                   db.func.coalesce(db.func.sum(Transaction.total_value_local), 0),
+                   db.func.count(Transaction.id))
+    expenses = _sums(scoped(Expense), Expense.date, bucket, start, end,
+                     db.func.coalesce(db.func.sum(Expense.amount), 0))
+
+    t = np.array(sorted(set(trades) | set(expenses)), dtype=np.int64)
+    zero = (0.0, 0.0, 0)
+    columns = {
+        't': t,
+        'profit': np.array([trades.get(k, zero)[0] for k in t.tolist()], dtype=np.float64),
+        'expenses': np.array([expenses.get(k, (0.0,))[0] for k in t.tolist()], dtype=np.float64),
+        'volume': np.array([trades.get(k, zero)[1] for k in t.tolist()], dtype=np.float64),
+        'trades': np.array([trades.get(k, zero)[2] for k in t.tolist()], dtype=np.int64),
+    }
+    columns['net'] = columns['profit'] - columns['expenses']
+    columns = _merge_buckets(columns, points)
+    out = {'bucket': bucket, 't': columns['t'].tolist()}
+    for name in ('profit', 'expenses', 'net', 'volume'):
+        out[name] = np.round(columns[name], 2).tolist()
+    out['trades'] = columns['trades'].tolist()
+    return out
+
+
+def _epoch(day):
+    return int(datetime.combine(day, datetime.min.time()).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _as_date(value):
+    return value if isinstance(value, date) else datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _open_intervals(first_day, last_day, closed_days):
+    """Inclusive (from, to) day ranges in [first_day, last_day] not covered by a close."""
+    intervals, day = [], first_day
+    for closed in closed_days:
+        if closed > day:
+            intervals.append((day, closed - timedelta(days=1)))
+        day = max(day, closed + timedelta(days=1))
+    if day <= last_day:
+        intervals.append((day, last_day))
+    return intervals
+
+
+def _daily_balances(currency_ids, start, end, branch_id):
+    """{currency_id: [(day, balance), ...]} of day-end balances over [start, end).
+
+    Closed days come from their checkpoints. Every other day is read from the
+    cashbox, and appears only when a ledger moved that day; the consolidated
+    balance carries every other branch's last known balance.
+    """
+    first_day, last_day = start.date(), (end - timedelta(days=1)).date()
+    series = defaultdict(list)
+
+    q = apply_scope(db.session.query(DailyClose.currency_id, DailyClose.branch_id, DailyClose.day,
+                                     DailyClose.closing_balance)
+                    .filter(DailyClose.currency_id.in_(currency_ids),
+                            DailyClose.day >= first_day, DailyClose.day <= last_day), DailyClose, branch_id)
+    closes = defaultdict(dict)  # (currency_id, day) -> {branch_id: closing balance}
+    for cid, bid, day, balance in q:
+        closes[cid, day][bid] = balance
+    for (cid, day), by_branch in closes.items():
+        series[cid].append((day, sum(by_branch.values())))
+    closed_days = {day for _, day in closes}
+
+    intervals = _open_intervals(first_day, last_day, sorted(closed_days))
+    if intervals:
+        branches = all_branch_ids() if branch_id is ALL_BRANCHES else [branch_id]
+        day = db.func.date(Cashbox.date)
+        rn = db.func.row_number().over(
+            partition_by=(Cashbox.currency_id, Cashbox.branch_id, day),
+            order_by=(Cashbox.date.desc(), Cashbox.id.desc()),
+        ).label('rn')
+        bounds = [db.and_(Cashbox.date >= datetime.combine(a, datetime.min.time()),
+                          Cashbox.date < datetime.combine(b + timedelta(days=1), datetime.min.time()))
+                  for a, b in intervals]
+        q = (db.session.query(Cashbox.currency_id, Cashbox.branch_id, day.label('day'), Cashbox.balance_after, rn)
+             .filter(Cashbox.currency_id.in_(currency_ids), db.or_(*bounds)))
+        last_rows = apply_scope(q, Cashbox, branch_id).subquery()
+        rows = (db.session.query(last_rows.c.currency_id, last_rows.c.branch_id, last_rows.c.day,
+                                 last_rows.c.balance_after)
+                .filter(last_rows.c.rn == 1)
+                .order_by(last_rows.c.day)
+                .all())
+        moves = defaultdict(list)
+        for cid, bid, d, balance in rows:
+            moves[cid].append((bid, _as_date(d), balance or 0))
+
+        for cid in currency_ids:
+            pending, k = moves[cid], 0
+            balances = dict.fromkeys(branches, 0)
+            if intervals[0][0] == first_day:
+                balances = {bid: balance_as_of(cid, first_day - timedelta(days=1), bid) for bid in branches}
+            for a, b in intervals:
+                # Every later interval follows a closed day, whose checkpoints
+                # are the balances it starts from
+                balances.update(closes.get((cid, a - timedelta(days=1)), {}))
+                if a == first_day and not (k < len(pending) and pending[k][1] == a):
+                    series[cid].append((a, sum(balances.values())))
+                current = None
+                while k < len(pending) and pending[k][1] <= b:
+                    bid, d, balance = pending[k]
+                    k += 1
+                    if current is not None and d != current:
+                        series[cid].append((current, sum(balances.values())))
+                    balances[bid], current = balance, d
+                if current is not None:
+                    series[cid].append((current, sum(balances.values())))
+
+    for cid, points in series.items():
+        points.sort()
+        # Carry the last balance to the end of the range
+        if points and points[-1][0] < last_day:
+            points.append((last_day, points[-1][1]))
+    return series
+
+
+def balance_series(currencies, start, end, points=DEFAULT_POINTS, branch_id=ALL_BRANCHES):
+    """Day-end cashbox balance per currency code, each downsampled with LTTB to `points`."""
+    by_id = {c.id: c.code for c in currencies}
+    result = {}
+    for cid, rows in _daily_balances(list(by_id), start, end, branch_id).items():
+        if cid not in by_id:
+            continue
+        t = np.array([_epoch(d) for d, _ in rows], dtype=np.int64)
+        v = np.array([b or 0 for _, b in rows], dtype=np.float64)
+        keep = lttb(t, v, points)
+        result[by_id[cid]] = {'t': t[keep].tolist(), 'balance': np.round(v[keep], 2).tolist()}
+    return {'bucket': 'day', 'series': result}
+
+
+def chart_currencies(codes):
+    """(currencies, unknown codes) for a comma separated code list; every currency when empty."""
+    q = Currency.query.order_by(Currency.id)
+    wanted = [c.strip().upper() for c in (codes or '').split(',') if c.strip()]
+    if not wanted:
+        return q.all(), []
+    currencies = q.filter(Currency.code.in_(wanted)).all()
+    found = {c.code for c in currencies}
+    return currencies, [code for code in wanted if code not in found]
@@ -0,0 +1,24 @@
+# close_day.py
+# مهمة إقفال نهاية اليوم: python close_day.py [YYYY-MM-DD]  (الافتراضي: أمس)
+import sys
+from datetime import datetime, timedelta
+from app import create_app
+from closing import close_day
+
+app = create_app()
+app.app_context().push()
+
+if len(sys.argv) > 1:
+    day = datetime.strptime(sys.argv[1], '%Y-%m-%d').date()
+else:
+    day = datetime.utcnow().date() - timedelta(days=1)
+
+try:
+    rows = close_day(day, closed_by='cli')
+except ValueError as e:
+    print(f"❌ {e}")
+    sys.exit(1)
+
+for r in rows:
+    print(f"{r.currency.code}: opening={r.opening_balance:,.2f} in={r.inflow:,.2f} out={r.outflow:,.2f} closing={r.closing_balance:,.2f} profit={r.profit:,.2f}")
+print(f"✅ Day {day} closed.")
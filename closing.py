@@ -0,0 +1,111 @@
+from datetime import datetime, time, timedelta
+from models import db, Currency, Transaction, Cashbox, DailyClose
+from branches import ALL_BRANCHES, all_branch_ids
+
+
+def _as_day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def day_bounds(day):
+    """Return the [start, end) datetimes that cover a calendar day."""
+    start = datetime.combine(_as_day(day), time.min)
+    return start, start + timedelta(days=1)
+
+
+def is_day_closed(value):
+    """True if the day containing `value` (date or datetime) has been closed."""
+    if value is None:
+        return False
+    return db.session.query(DailyClose.id).filter_by(day=_as_day(value)).first() is not None
+
+
+def last_closed_day():
+    return db.session.query(db.func.max(DailyClose.day)).scalar()
+
+
+def balance_as_of(currency_id, day, branch_id=ALL_BRANCHES):
+    """Cashbox balance of a currency at the end of `day`.
+
+    Closed days are answered straight from their checkpoint. Otherwise the
+    nearest earlier checkpoint bounds the ledger search, so with a daily close
+    job only the rows of the open day are looked at. With ALL_BRANCHES the
+    per-branch balances are summed.
+    """
+    if branch_id is ALL_BRANCHES:
+        return sum(balance_as_of(currency_id, day, bid) for bid in all_branch_ids())
+
+    day = _as_day(day)
+    _, end = day_bounds(day)
+    checkpoint = (DailyClose.query
+                  .filter(DailyClose.currency_id == currency_id, DailyClose.branch_id == branch_id,
+                          DailyClose.day <= day)
+                  .order_by(DailyClose.day.desc())
+                  .first())
+    if checkpoint is not None and checkpoint.day == day:
+        return checkpoint.closing_balance
+
+    q = Cashbox.query.filter(Cashbox.currency_id == currency_id, Cashbox.branch_id == branch_id, Cashbox.date < end)
+    if checkpoint is not None:
+        q = q.filter(Cashbox.date >= day_bounds(checkpoint.day)[1])
+    last = q.order_by(Cashbox.date.desc(), Cashbox.id.desc()).first()
+    if last is not None:
+        return last.balance_after
+    return checkpoint.closing_balance if checkpoint is not None else 0
+
+
+def close_day(day, closed_by=None):
+    """Write one immutable checkpoint per branch and currency for `day` and lock it.
+
+    Raises ValueError if the day is in the future or already closed.
+    """
+    day = _as_day(day)
+    if day > datetime.utcnow().date():
+        raise ValueError('لا يمكن إقفال يوم في المستقبل')
+    if is_day_closed(day):
+        raise ValueError('تم إقفال هذا اليوم مسبقاً')
+
+    start, end = day_bounds(day)
+    flows = dict(
+        ((bid, cid), (inflow, outflow)) for bid, cid, inflow, outflow in db.session.query(
+            Cashbox.branch_id,
+            Cashbox.currency_id,
+            db.func.coalesce(db.func.sum(Cashbox.inflow), 0),
+            db.func.coalesce(db.func.sum(Cashbox.outflow), 0),
+        ).filter(Cashbox.date >= start, Cashbox.date < end).group_by(Cashbox.branch_id, Cashbox.currency_id)
+    )
+    profits = dict(
+        ((bid, cid), profit) for bid, cid, profit in db.session.query(
+            Transaction.branch_id,
+            Transaction.currency_id,
+            db.func.coalesce(db.func.sum(Transaction.profit), 0),
+        ).filter(Transaction.date >= start, Transaction.date < end).group_by(Transaction.branch_id, Transaction.currency_id)
+    )
+
+    previous_day = day - timedelta(days=1)
+    rows = []
+    for branch_id in all_branch_ids():
+        for c in Currency.query.order_by(Currency.id).all():
+            inflow, outflow = flows.get((branch_id, c.id), (0, 0))
+            opening = balance_as_of(c.id, previous_day, branch_id)
+            # The ledger's own balance_after is authoritative for the close; a
+            # currency with no movement that day simply carries its opening balance.
+            last = (Cashbox.query
+                    .filter(Cashbox.currency_id == c.id, Cashbox.branch_id == branch_id, Cashbox.date < end)
+                    .order_by(Cashbox.date.desc(), Cashbox.id.desc())
+                    .first())
+            closing = last.balance_after if last and last.date >= start else opening
+            rows.append(DailyClose(
+                day=day,
+                branch_id=branch_id,
+                currency_id=c.id,
+                opening_balance=opening,
+                inflow=inflow,
+                outflow=outflow,
+                closing_balance=closing,
+                profit=profits.get((branch_id, c.id), 0),
+                closed_by=closed_by,
+            ))
+    db.session.add_all(rows)
+    db.session.commit()
+    return rows
@@ -0,0 +1,109 @@
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only without it
+    brotli = None
+
+# Dynamic responses (HTML pages, JSON, CSV) are compressed on the way out when
+# the client accepts it. Streamed responses are compressed chunk by chunk with
+# a sync flush so rows still reach the client as they are produced. File
+# downloads (send_file) and responses that already carry an encoding, such as
+# the precompressed /assets files, pass through untouched.
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript',
+    'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml',
+}
+
+
+class _GzipStream:
+    def __init__(self, level):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = gzip container
+
+    def chunk(self, data):
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._z.flush()
+
+
+class _BrotliStream:
+    def __init__(self, quality):
+        self._c = brotli.Compressor(quality=quality)
+
+    def chunk(self, data):
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self):
+        return self._c.finish()
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _should_compress(response, config):
+    if not config.get('COMPRESS_ENABLED', True):
+        return False
+    if response.direct_passthrough or response.status_code in (204, 206, 304) or response.status_code < 200:
+        return False
+    if 'Content-Encoding' in response.headers or 'no-transform' in response.headers.get('Cache-Control', ''):
+        return False
+    return response.mimetype in COMPRESSIBLE_TYPES
+
+
+def _stream(original, chunks, compressor):
+    try:
+        for data in chunks:
+            out = compressor.chunk(data)
+            if out:
+                yield out
+        yield compressor.finish()
+    finally:
+        if hasattr(original, 'close'):
+            original.close()
+
+
+def compress_response(response, config):
+    if not _should_compress(response, config):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        if encoding == 'br':
+            compressor = _BrotliStream(config.get('COMPRESS_BR_QUALITY', 4))
+        else:
+            compressor = _GzipStream(config.get('COMPRESS_LEVEL', 6))
+        response.response = _stream(response.response, response.iter_encoded(), compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get('COMPRESS_MIN_SIZE', 500):
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=config.get('COMPRESS_BR_QUALITY', 4))
+        else:
+            data = gzip.compress(data, compresslevel=config.get('COMPRESS_LEVEL', 6), mtime=0)
+        response.set_data(data)
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # the bytes differ from the identity representation
+    return response
+
+
+def init_app(app):
+    @app.after_request
+    def _compress(response):
+        return compress_response(response, app.config)
@@ -1,5 +1,34 @@
 import os
+import tempfile
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'database.db')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SECRET_KEY = os.environ.get('SECRET_KEY', 'change-this-secret')
+# Cost basis for currency positions: 'average' (weighted average) or 'fifo'
+COST_BASIS_METHOD = os.environ.get('COST_BASIS_METHOD', 'average')
+# Response compression (gzip, or brotli when installed) for pages and API output
+COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') != '0'
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+COMPRESS_BR_QUALITY = 4
+# Compiled Jinja templates persist here across restarts; set to '' to disable
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'exchange-jinja-cache'))
+FRAGMENT_CACHE_ENABLED = True
+# Import pandas/xhtml2pdf in the background at startup instead of on first export
+PRELOAD_EXPORTS = os.environ.get('PRELOAD_EXPORTS', '0') == '1'
+# SQLite concurrency: WAL journal and how long writers wait for the write lock
+SQLITE_WAL = os.environ.get('SQLITE_WAL', '1') != '0'
+SQLITE_BUSY_TIMEOUT_MS = 10000
+# Quote engine: spread applied to pairs without their own setting, and how
+# often a worker checks for rate changes made by other workers
+QUOTE_DEFAULT_SPREAD_BPS = float(os.environ.get('QUOTE_DEFAULT_SPREAD_BPS', 50))
+QUOTE_REFRESH_SECONDS = 5
+# Browser cache lifetime of chart data; ranges that end inside closed days are cached for a day
+CHART_CACHE_SECONDS = 60
+# Online backups: where they go, pages copied per step (4 KB each) and the pause
+# between steps, and retention (newest N backups plus one per day for N days)
+BACKUP_DIR = os.environ.get('BACKUP_DIR', os.path.join(BASE_DIR, 'backups'))
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.002
+BACKUP_KEEP_LAST = 7
+BACKUP_KEEP_DAILY = 30
@@ -0,0 +1,86 @@
+from datetime import timedelta
+from models import db, Currency, Debt
+from branches import ALL_BRANCHES, apply_scope
+
+# (key, label) ordered from not yet due to most overdue
+AGING_BUCKETS = [
+    ('current', 'غير مستحق'),
+    ('d30', '1-30 يوم'),
+    ('d60', '31-60 يوم'),
+    ('d90', '61-90 يوم'),
+    ('d90p', 'أكثر من 90 يوم'),
+]
+
+
+def _open_debts():
+    return Debt.is_paid == False  # noqa: E712  (SQL comparison, matches ix_debt_paid_due)
+
+
+def person_prefix(prefix):
+    """Names starting with `prefix`, as a range on person_name.
+
+    Unlike LIKE 'x%' this can seek ix_debt_person, and % or _ in the input
+    match themselves. U+10FFFF sorts after every other character in
+    SQLite's binary collation, so it closes the range.
+    """
+    return db.and_(Debt.person_name >= prefix, Debt.person_name < prefix + '\U0010ffff')
+
+
+def _bucket_expr(today):
+    return db.case(
+        (Debt.due_date == None, 'current'),  # noqa: E711
+        (Debt.due_date >= today, 'current'),
+        (Debt.due_date >= today - timedelta(days=30), 'd30'),
+        (Debt.due_date >= today - timedelta(days=60), 'd60'),
+        (Debt.due_date >= today - timedelta(days=90), 'd90'),
+        else_='d90p',
+    )
+
+
+def aging_report(today, branch_id=ALL_BRANCHES):
+    """Outstanding amount and count per currency and aging bucket.
+
+    Returns {currency_code: {bucket_key: {'amount': x, 'count': n}}}.
+    """
+    bucket = _bucket_expr(today).label('bucket')
+    q = (db.session.query(Currency.code, bucket,
+                          db.func.coalesce(db.func.sum(Debt.amount), 0),
+                          db.func.count(Debt.id))
+         .join(Currency, Currency.id == Debt.currency_id)
+         .filter(_open_debts()))
+    rows = apply_scope(q, Debt, branch_id).group_by(Currency.code, bucket).all()
+    report = {}
+    for code, key, amount, count in rows:
+        buckets = report.setdefault(code, {k: {'amount': 0, 'count': 0} for k, _ in AGING_BUCKETS})
+        buckets[key] = {'amount': amount, 'count': count}
+    return report
+
+
+def exposure_by_person(person=None, limit=100, offset=0, branch_id=ALL_BRANCHES):
+    """Outstanding total per counterparty and currency, largest first."""
+    total = db.func.sum(Debt.amount).label('total')
+    q = (db.session.query(Debt.person_name, Currency.code, total,
+                          db.func.count(Debt.id), db.func.min(Debt.due_date))
+         .join(Currency, Currency.id == Debt.currency_id)
+         .filter(_open_debts()))
+    if person:
+        q = q.filter(person_prefix(person))
+    rows = (apply_scope(q, Debt, branch_id).group_by(Debt.person_name, Currency.code)
+            .order_by(total.desc())
+            .limit(limit).offset(offset)
+            .all())
+    return [{'person_name': name, 'currency': code, 'amount': amount,
+             'count': count, 'oldest_due': due.isoformat() if due else None}
+            for name, code, amount, count, due in rows]
+
+
+def overdue_summary(today, branch_id=ALL_BRANCHES):
+    """Unpaid debts past due and due today, per currency — served from ix_debt_paid_due."""
+    summary = {'date': today.isoformat(), 'overdue': {}, 'due_today': {}}
+    for key, cond in (('overdue', Debt.due_date < today), ('due_today', Debt.due_date == today)):
+        q = (db.session.query(Currency.code, db.func.sum(Debt.amount), db.func.count(Debt.id))
+             .join(Currency, Currency.id == Debt.currency_id)
+             .filter(_open_debts(), cond))
+        rows = apply_scope(q, Debt, branch_id).group_by(Currency.code).all()
+        summary[key] = {code: {'amount': amount, 'count': count} for code, amount, count in rows}
+    return summary
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, FloatField, SelectField, TextAreaField, SubmitField, DateField, BooleanField
-from wtforms.validators import DataRequired, Length, Optional
+from wtforms.validators import DataRequired, Length, Optional, InputRequired, NumberRange
 class LoginForm(FlaskForm):
     username = StringField('اسم المستخدم', validators=[DataRequired()])
     password = PasswordField('كلمة المرور', validators=[DataRequired()])
@@ -15,6 +15,7 @@ class UserForm(FlaskForm):
         ('editor', 'محرر'),
         ('viewer', 'عارض')
     ], validators=[DataRequired()])
+    branch_id = SelectField('الفرع', coerce=int, default=0)
     submit = SubmitField('حفظ المستخدم')
 
 
@@ -59,4 +60,22 @@ class DebtForm(FlaskForm):
     due_date = DateField('تاريخ الاستحقاق', format='%Y-%m-%d', validators=[Optional()])
     notes = TextAreaField('ملاحظات')
     is_paid = BooleanField('تم السداد')
-    submit = SubmitField('حفظ الدين')
\ No newline at end of file
+    submit = SubmitField('حفظ الدين')
+
+
+class BranchForm(FlaskForm):
+    name = StringField('اسم الفرع', validators=[DataRequired(), Length(max=100)])
+    code = StringField('رمز الفرع', validators=[DataRequired(), Length(max=10)])
+    submit = SubmitField('حفظ الفرع')
+
+
+class CloseDayForm(FlaskForm):
+    day = DateField('اليوم', format='%Y-%m-%d', validators=[DataRequired()])
+    submit = SubmitField('إقفال اليوم')
+
+
+class PairSpreadForm(FlaskForm):
+    from_currency_id = SelectField('من عملة', coerce=int, validators=[DataRequired()])
+    to_currency_id = SelectField('إلى عملة', coerce=int, validators=[DataRequired()])
+    spread_bps = FloatField('الهامش (نقطة أساس)', validators=[InputRequired(), NumberRange(min=0, max=10000)])
+    submit = SubmitField('حفظ الهامش')
@@ -1,16 +1,15 @@
 # init_db.py
 from app import create_app
 from models import db, User, Currency, Cashbox, Expense, Transaction
+from positions import rebuild_all
 import bcrypt
 from datetime import datetime, timedelta, timezone
 import random
 
+# create_app() ينشئ الجداول والفهارس وفهرس البحث النصي
 app = create_app()
 app.app_context().push()
 
-# إنشاء الجداول
-db.create_all()
-
 # إضافة مستخدم admin إذا لم يكن موجود
 if not User.query.filter_by(username='admin').first():
     pw = bcrypt.hashpw('admin123'.encode(), bcrypt.gensalt()).decode()
@@ -105,4 +104,7 @@ if not Transaction.query.first():
 
 db.session.commit()
 
+# بناء مراكز العملات (الكلفة والربح المحقق) من سجل العمليات
+rebuild_all()
+
 print("✅ Database initialized with demo data successfully!")
@@ -0,0 +1,338 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+from models import db, Cashbox, Transaction, Expense
+from closing import is_day_closed, last_closed_day
+
+# Core table, not the mapped class: executing an ORM insert/update with a
+# parameter dict would switch SQLAlchemy into bulk-by-primary-key mode.
+cashbox = Cashbox.__table__
+
+# Every (branch, currency) pair keeps its own running cashbox ledger, ordered
+# by (date, id). A post must read the newest balance_after and append on top
+# of it; done as a SELECT followed by an INSERT, two tellers posting the same
+# ledger could both read the same previous balance. The statements below fold
+# the read into the write, so SQLite evaluates it under the write lock and a
+# concurrent post always builds on the one committed before it. Posts to other
+# currencies only ever touch their own rows.
+#
+# The statements are built once with bind parameters; posting is on the hot
+# path of every transaction and expense.
+
+
+def _newest(column):
+    # IS (not =) so a NULL branch_id selects the head-office ledger
+    return (db.select(column)
+            .where(cashbox.c.currency_id == db.bindparam('b_currency_id'),
+                   cashbox.c.branch_id.is_not_distinct_from(db.bindparam('b_branch_id')))
+            .order_by(cashbox.c.date.desc(), cashbox.c.id.desc())
+            .limit(1)
+            .scalar_subquery())
+
+
+def _post_statement():
+    now = db.bindparam('b_now', type_=db.DateTime)
+    inflow = db.bindparam('b_inflow', type_=db.Float)
+    outflow = db.bindparam('b_outflow', type_=db.Float)
+    select = db.select(
+        # Never date a row before the newest one, so it always sorts last
+        db.func.max(now, db.func.coalesce(_newest(cashbox.c.date), now)),
+        db.bindparam('b_currency_id', type_=db.Integer),
+        db.bindparam('b_branch_id', type_=db.Integer),
+        inflow,
+        outflow,
+        db.func.coalesce(_newest(cashbox.c.balance_after), 0) + inflow - outflow,
+        db.bindparam('b_transaction_id', type_=db.Integer),
+        db.bindparam('b_expense_id', type_=db.Integer),
+    )
+    return (db.insert(cashbox)
+            .from_select(['date', 'currency_id', 'branch_id', 'inflow', 'outflow', 'balance_after',
+                          'transaction_id', 'expense_id'], select)
+            .returning(cashbox.c.id, cashbox.c.balance_after))
+
+
+def _adjust_statement():
+    return (db.update(cashbox)
+            .where(cashbox.c.id == _newest(cashbox.c.id))
+            .values(balance_after=cashbox.c.balance_after + db.bindparam('b_delta', type_=db.Float),
+                    inflow=db.func.coalesce(cashbox.c.inflow, 0) + db.bindparam('b_d_inflow', type_=db.Float),
+                    outflow=db.func.coalesce(cashbox.c.outflow, 0) + db.bindparam('b_d_outflow', type_=db.Float)))
+
+
+_POST = _post_statement()
+_ADJUST = _adjust_statement()
+
+
+def post_cashbox(currency_id, branch_id, inflow=0, outflow=0, transaction_id=None, expense_id=None):
+    """Append a ledger row atomically. Returns (id, balance_after)."""
+    row = db.session.execute(_POST, {'b_now': datetime.utcnow(), 'b_currency_id': currency_id, 'b_branch_id': branch_id,
+                                     'b_inflow': inflow, 'b_outflow': outflow,
+                                     'b_transaction_id': transaction_id, 'b_expense_id': expense_id}).one()
+    return tuple(row)
+
+
+def adjust_last_cashbox(currency_id, branch_id, delta, inflow=0, outflow=0):
+    """Shift the newest row's balance (and flows) by the given amounts in one UPDATE.
+
+    Only used for a source whose movement cannot be found; see
+    repost_source. Returns False when the ledger is empty. Raises ValueError
+    when the newest row falls on a closed day.
+    """
+    params = {'b_currency_id': currency_id, 'b_branch_id': branch_id}
+    if is_day_closed(db.session.execute(db.select(_newest(cashbox.c.date)), params).scalar()):
+        raise ValueError('آخر حركة في الصندوق تقع في يوم مُقفل')
+    result = db.session.execute(_ADJUST, dict(params, b_delta=delta, b_d_inflow=inflow, b_d_outflow=outflow))
+    return result.rowcount > 0
+
+
+def _source_row(old, transaction_id=None, expense_id=None):
+    """The cashbox row a source posted: by reference, else (older rows) the
+    newest unreferenced row of its ledger with the same flows."""
+    columns = (cashbox.c.id, cashbox.c.date, cashbox.c.currency_id, cashbox.c.branch_id,
+               db.func.coalesce(cashbox.c.inflow, 0).label('inflow'),
+               db.func.coalesce(cashbox.c.outflow, 0).label('outflow'))
+    column, value = ((cashbox.c.transaction_id, transaction_id) if transaction_id is not None
+                     else (cashbox.c.expense_id, expense_id))
+    row = db.session.execute(db.select(*columns).where(column == value)
+                             .order_by(cashbox.c.id.desc()).limit(1)).first()
+    if row is not None:
+        return row
+    currency_id, branch_id, inflow, outflow = old
+    return db.session.execute(
+        db.select(*columns)
+        .where(cashbox.c.currency_id == currency_id, cashbox.c.branch_id.is_not_distinct_from(branch_id),
+               cashbox.c.transaction_id.is_(None), cashbox.c.expense_id.is_(None),
+               db.func.abs(db.func.coalesce(cashbox.c.inflow, 0) - inflow) < TOLERANCE,
+               db.func.abs(db.func.coalesce(cashbox.c.outflow, 0) - outflow) < TOLERANCE,
+               (db.func.coalesce(cashbox.c.inflow, 0) + db.func.coalesce(cashbox.c.outflow, 0)) > 0)
+        .order_by(cashbox.c.date.desc(), cashbox.c.id.desc())
+        .limit(1)).first()
+
+
+def _shift_from(row, delta):
+    """Add delta to the balance of `row` and of every later row in its ledger."""
+    db.session.execute(
+        db.update(cashbox)
+        .where(cashbox.c.currency_id == row.currency_id,
+               cashbox.c.branch_id.is_not_distinct_from(row.branch_id),
+               db.or_(cashbox.c.date > row.date, db.and_(cashbox.c.date == row.date, cashbox.c.id >= row.id)))
+        .values(balance_after=cashbox.c.balance_after + delta))
+
+
+def repost_source(old, new, transaction_id=None, expense_id=None):
+    """Correct the movement of an edited (new given) or deleted (new None) source.
+
+    old and new are (currency_id, branch_id, inflow, outflow). The row the
+    source posted takes the new flows and its ledger is re-chained from there,
+    so every later balance still equals the running sum. If the source moved
+    to another currency or branch, or was deleted, the row is removed instead
+    and a moved source is posted again in its new ledger.
+
+    Rows posted before movements carried their source are found by their
+    flows and get the reference when they are kept. Only when no row matches
+    is the newest row corrected with adjust_last_cashbox. Raises ValueError
+    when the change would touch a closed day. The caller commits.
+    """
+    ref = {'transaction_id': transaction_id, 'expense_id': expense_id}
+    row = _source_row(old, transaction_id, expense_id)
+    if row is None:
+        currency_id, branch_id, inflow, outflow = old
+        adjust_last_cashbox(currency_id, branch_id, outflow - inflow, inflow=-inflow, outflow=-outflow)
+        if new is not None:
+            currency_id, branch_id, inflow, outflow = new
+            if not adjust_last_cashbox(currency_id, branch_id, inflow - outflow, inflow=inflow, outflow=outflow):
+                post_cashbox(*new, **ref)
+        return
+
+    # Later balances of closed days are frozen in their checkpoints
+    closed = last_closed_day()
+    if closed is not None and row.date.date() <= closed:
+        raise ValueError('حركة الصندوق لهذا المستند تقع في يوم مُقفل')
+    moved = new is None or (new[0], new[1]) != (row.currency_id, row.branch_id)
+    inflow, outflow = (0, 0) if moved else new[2:]
+    _shift_from(row, (inflow - outflow) - (row.inflow - row.outflow))
+    if moved:
+        db.session.execute(db.delete(cashbox).where(cashbox.c.id == row.id))
+        if new is not None:
+            post_cashbox(*new, **ref)
+    else:
+        db.session.execute(db.update(cashbox).where(cashbox.c.id == row.id)
+                           .values(inflow=inflow, outflow=outflow,
+                                   **{k: v for k, v in ref.items() if v is not None}))
+
+
+def transaction_flows(kind, total):
+    """(inflow, outflow) a transaction posts: a sell takes cash in, a buy pays it out."""
+    return (total or 0, 0) if kind == 'sell' else (0, total or 0)
+
+
+# ----------------------------------------------------------------------
+# Verification and repair
+# ----------------------------------------------------------------------
+# Each ledger's first row is its opening balance. Every later balance_after
+# must equal that opening plus the running sum of inflow - outflow. Ledgers
+# are split into chunks and checked as a parallel prefix sum: chunk totals
+# first, then every chunk against its offset. Only the small list of chunk
+# totals is combined serially.
+
+TOLERANCE = 0.005
+CHUNK_ROWS = 50_000
+MAX_EXAMPLES = 20
+
+
+def ledger_keys():
+    """Every (branch_id, currency_id) pair that has cashbox rows."""
+    return [tuple(r) for r in db.session.execute(
+        db.select(cashbox.c.branch_id, cashbox.c.currency_id).distinct()
+        .order_by(cashbox.c.currency_id, cashbox.c.branch_id))]
+
+
+def load_ledger(branch_id, currency_id):
+    """Ledger columns in posting order as NumPy arrays: ids, net flow, stored balance."""
+    cursor = db.session.connection().connection.cursor()
+    try:
+        rows = cursor.execute(
+            "SELECT id, coalesce(inflow, 0) - coalesce(outflow, 0), coalesce(balance_after, 0) FROM cashbox "
+            "WHERE currency_id = ? AND branch_id IS ? ORDER BY date, id", (currency_id, branch_id)).fetchall()
+    finally:
+        cursor.close()
+    arr = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return arr[:, 0].astype(np.int64), arr[:, 1], arr[:, 2]
+
+
+def _chunks(n, size):
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def check_ledger(net, balance, pool, chunk_rows=CHUNK_ROWS):
+    """Expected balances by parallel prefix sum. Returns (expected, bad_mask)."""
+    n = len(net)
+    expected = np.empty(n)
+    if n == 0:
+        return expected, np.zeros(0, dtype=bool)
+    chunks = _chunks(n, chunk_rows)
+    totals = list(pool.map(lambda c: float(net[c[0]:c[1]].sum()), chunks))
+    # Balance before the first row: the opening row carries its own flows
+    offsets = np.concatenate(([balance[0] - net[0]], np.cumsum(totals)[:-1] + balance[0] - net[0]))
+
+    def fill(args):
+        (start, end), offset = args
+        np.cumsum(net[start:end], out=expected[start:end])
+        expected[start:end] += offset
+
+    list(pool.map(fill, zip(chunks, offsets)))
+    return expected, np.abs(expected - balance) > TOLERANCE
+
+
+def verify_cashbox(max_workers=8, chunk_rows=CHUNK_ROWS, currency_id=None):
+    """Check every ledger; one result dict per (branch, currency) ledger.
+
+    first_bad is the earliest row whose stored balance differs from the
+    running sum; every row after it usually carries the same drift.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for branch_id, cid in ledger_keys():
+            if currency_id is not None and cid != currency_id:
+                continue
+            ids, net, balance = load_ledger(branch_id, cid)
+            expected, bad = check_ledger(net, balance, pool, chunk_rows)
+            result = {'branch_id': branch_id, 'currency_id': cid, 'rows': len(ids),
+                      'bad_rows': int(bad.sum()), 'first_bad': None,
+                      'drift': float(balance[-1] - expected[-1]) if len(ids) else 0.0}
+            if bad.any():
+                i = int(np.argmax(bad))
+                date = db.session.execute(db.select(cashbox.c.date).where(cashbox.c.id == int(ids[i]))).scalar()
+                result['first_bad'] = {'index': i, 'id': int(ids[i]), 'date': date,
+                                       'balance_after': float(balance[i]), 'expected': float(expected[i])}
+            results.append(result)
+    return results
+
+
+def repair_cashbox(result, max_workers=8, chunk_rows=CHUNK_ROWS):
+    """Rewrite balance_after from the first divergent row of one ledger, in bulk.
+
+    Flows are taken as recorded; only the running balance is recomputed.
+    Returns the number of rows updated. The caller commits.
+    """
+    if not result['first_bad']:
+        return 0
+    ids, net, balance = load_ledger(result['branch_id'], result['currency_id'])
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        expected, _ = check_ledger(net, balance, pool, chunk_rows)
+    start = result['first_bad']['index']
+    db.session.execute(
+        db.update(cashbox).where(cashbox.c.id == db.bindparam('b_id')).values(balance_after=db.bindparam('b_balance')),
+        [{'b_id': int(i), 'b_balance': float(b)} for i, b in zip(ids[start:], expected[start:])])
+    return len(ids) - start
+
+
+def match_sources(currency_id=None):
+    """Pair transactions and expenses with their cashbox movements.
+
+    Rows posted with a transaction_id/expense_id are matched by reference and
+    must carry the source amount. Older rows without one are matched by
+    (branch, currency, direction, amount). Returns examples of sources without
+    a movement, referenced movements whose amount differs, movements whose
+    referenced source no longer exists (orphaned), and movements that match
+    no source. Rows without flows (openings, reversed postings) are ignored.
+    """
+    sources = {}
+    tx = db.session.query(Transaction.id, Transaction.branch_id, Transaction.currency_id, Transaction.type,
+                          Transaction.total_value_local)
+    ex = db.session.query(Expense.id, Expense.branch_id, Expense.currency_id, Expense.amount)
+    moves = db.session.query(cashbox.c.id, cashbox.c.branch_id, cashbox.c.currency_id, cashbox.c.inflow,
+                             cashbox.c.outflow, cashbox.c.transaction_id, cashbox.c.expense_id)
+    if currency_id is not None:
+        tx = tx.filter(Transaction.currency_id == currency_id)
+        ex = ex.filter(Expense.currency_id == currency_id)
+        moves = moves.filter(cashbox.c.currency_id == currency_id)
+    for i, b, c, kind, total in tx:
+        sources[('transaction', i)] = (b, c, 'in' if kind == 'sell' else 'out', round(total or 0, 2))
+    for i, b, c, amount in ex:
+        sources[('expense', i)] = (b, c, 'out', round(amount or 0, 2))
+
+    mismatched, unreferenced, unmatched = [], defaultdict(list), []
+    for cid, b, c, inflow, outflow, tx_id, exp_id in moves:
+        direction, amount = ('in', inflow or 0) if (inflow or 0) else ('out', outflow or 0)
+        key = ('transaction', tx_id) if tx_id else ('expense', exp_id) if exp_id else None
+        if key in sources:
+            source = sources.pop(key)
+            if source != (b, c, direction, round(amount, 2)):
+                mismatched.append({'cashbox_id': cid, 'source': key, 'expected': source[3], 'recorded': amount})
+        elif key is not None:
+            if amount:
+                unmatched.append((cid, key, amount))
+        elif amount:
+            unreferenced[(b, c, direction, round(amount, 2))].append(cid)
+
+    # A reference that matched nothing is either a second movement for an
+    # existing source (or one in another currency), or points at a deleted one
+    existing = set()
+    for kind, model in (('transaction', Transaction), ('expense', Expense)):
+        ids = [key[1] for _, key, _ in unmatched if key[0] == kind]
+        if ids:
+            existing.update((kind, i) for (i,) in db.session.query(model.id).filter(model.id.in_(ids)))
+    orphaned = []
+    for cid, key, amount in unmatched:
+        if key in existing:
+            mismatched.append({'cashbox_id': cid, 'source': key, 'expected': None, 'recorded': amount})
+        else:
+            orphaned.append({'cashbox_id': cid, 'source': key, 'amount': amount})
+
+    missing = []
+    for key, signature in sources.items():
+        candidates = unreferenced.get(signature)
+        if candidates:
+            candidates.pop()
+        else:
+            missing.append({'source': key, 'branch_id': signature[0], 'currency_id': signature[1],
+                            'amount': signature[3]})
+    unexplained = sorted(cid for ids in unreferenced.values() for cid in ids)
+    return {
+        'missing': len(missing), 'mismatched': len(mismatched), 'orphaned': len(orphaned),
+        'unexplained': len(unexplained),
+        'examples': {'missing': missing[:MAX_EXAMPLES], 'mismatched': mismatched[:MAX_EXAMPLES],
+                     'orphaned': orphaned[:MAX_EXAMPLES], 'unexplained': unexplained[:MAX_EXAMPLES]},
+    }
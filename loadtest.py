@@ -0,0 +1,298 @@
+# loadtest.py
+# اختبار حمل: عدد من الصرافين الافتراضيين المتزامنين على create_app() مع قاعدة بيانات مؤقتة مجهزة بالبيانات
+# python loadtest.py [--users 20] [--duration 60] [--think 0.5] [--history 5000] [--json result.json]
+# python loadtest.py --url http://127.0.0.1:8000 --username teller --password secret   (خادم قائم)
+import argparse
+import gzip
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timedelta
+import numpy as np
+import config
+
+parser = argparse.ArgumentParser(description='Concurrent teller load test.')
+parser.add_argument('--users', type=int, default=20, help='concurrent virtual users')
+parser.add_argument('--duration', type=float, default=60, help='seconds of load after ramp-up starts')
+parser.add_argument('--ramp', type=float, default=5, help='seconds over which users start')
+parser.add_argument('--think', type=float, default=0.5, help='mean think time between actions (seconds)')
+parser.add_argument('--history', type=int, default=5000, help='seeded transactions')
+parser.add_argument('--branches', type=int, default=3)
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--url', help='test a running server instead of booting create_app() on a seeded database')
+parser.add_argument('--username', default='admin')
+parser.add_argument('--password', default='admin123')
+parser.add_argument('--json', help='write the results to this file')
+parser.add_argument('--max-error-rate', type=float, default=0.01)
+args = parser.parse_args()
+random.seed(args.seed)
+
+PASSWORD = 'loadtest'
+CURRENCIES = [('USD', 'دولار أمريكي', 1310), ('EUR', 'يورو', 1420), ('GBP', 'جنيه إسترليني', 1650),
+              ('TRY', 'ليرة تركية', 40), ('IQD', 'دينار عراقي', 1)]
+
+# Scripted session: (action, weight). Each virtual user logs in once, then
+# repeats weighted actions with exponential think time until the run ends.
+ACTIONS = [
+    ('dashboard', 30),
+    ('chart_poll', 10),
+    ('transaction_add', 25),
+    ('transactions', 8),
+    ('cashbox', 8),
+    ('expenses', 5),
+    ('debts', 4),
+    ('quote', 5),
+    ('export_xlsx', 3),
+    ('export_pdf', 2),
+]
+GET_ROUTES = {
+    'dashboard': '/',
+    'chart_poll': '/api/charts/flows?days=90&points=150',
+    'transactions': '/transactions',
+    'cashbox': '/cashbox',
+    'expenses': '/expenses',
+    'debts': '/debts',
+    'export_xlsx': '/reports/export/transactions.xlsx',
+    'export_pdf': '/reports/export/summary.pdf',
+}
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+OPTION = re.compile(r'<option value="(\d+)"')
+
+lock_errors = []
+
+
+def seed(app):
+    """Tellers spread over branches, opening balances and a trading history."""
+    import bcrypt
+    from models import db, User, Branch, Currency, Cashbox, Transaction, Expense
+    from positions import rebuild_all
+
+    with app.app_context():
+        branches = [Branch(name=f'فرع {i + 1}', code=f'B{i + 1}') for i in range(args.branches)]
+        currencies = [Currency(code=code, name=name, rate=rate) for code, name, rate in CURRENCIES]
+        db.session.add_all(branches + currencies)
+        db.session.flush()
+        pw = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(4)).decode()
+        db.session.add(User(username='admin', password_hash=pw, role='admin'))
+        for n in range(args.users):
+            db.session.add(User(username=f'teller{n}', password_hash=pw, role='editor',
+                                branch_id=branches[n % len(branches)].id if branches else None))
+
+        ledgers = [(b.id, c) for b in branches for c in currencies] + [(None, c) for c in currencies]
+        balances = {(bid, c.id): 1_000_000.0 / c.rate for bid, c in ledgers}
+        start = datetime.utcnow() - timedelta(days=90)
+        cashbox = [{'date': start, 'currency_id': cid, 'branch_id': bid, 'inflow': 0.0, 'outflow': 0.0,
+                    'balance_after': balance} for (bid, cid), balance in balances.items()]
+        trades, expenses = [], []
+        for i in range(args.history):
+            bid, c = random.choice(ledgers)
+            kind = random.choice(('buy', 'sell'))
+            qty = round(random.uniform(10, 2000), 2)
+            buy, sell = c.rate * 0.995, c.rate * 1.005
+            total = (sell if kind == 'sell' else buy) * qty
+            date = start + timedelta(seconds=i * 90 * 86400 / max(args.history, 1))
+            trades.append({'date': date, 'type': kind, 'currency_id': c.id, 'quantity': qty, 'buy_rate': buy,
+                           'sell_rate': sell, 'total_value_local': total, 'profit': (sell - buy) * qty,
+                           'branch_id': bid})
+            if i % 20 == 0:
+                expenses.append({'date': date, 'category': 'تشغيل', 'amount': 50.0, 'currency_id': c.id,
+                                 'branch_id': bid})
+        db.session.execute(Transaction.__table__.insert(), trades)
+        db.session.execute(Expense.__table__.insert(), expenses)
+        # Cashbox rows reference their source, so the ledger check at the end covers the history too
+        ids = [i for (i,) in db.session.query(Transaction.id).order_by(Transaction.id)]
+        for tx_id, t in zip(ids, trades):
+            key = (t['branch_id'], t['currency_id'])
+            inflow = t['total_value_local'] if t['type'] == 'sell' else 0.0
+            outflow = t['total_value_local'] if t['type'] == 'buy' else 0.0
+            balances[key] += inflow - outflow
+            cashbox.append({'date': t['date'], 'currency_id': key[1], 'branch_id': key[0], 'inflow': inflow,
+                            'outflow': outflow, 'balance_after': balances[key], 'transaction_id': tx_id})
+        db.session.execute(Cashbox.__table__.insert(), cashbox)
+        db.session.commit()
+        rebuild_all()
+
+
+def boot():
+    """Create the app on a temporary seeded database and serve it on a free local port."""
+    from flask import got_request_exception
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    logging.getLogger('xhtml2pdf').setLevel(logging.ERROR)
+
+    tmp = tempfile.TemporaryDirectory()
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp.name, 'loadtest.db')
+    config.BACKUP_DIR = os.path.join(tmp.name, 'backups')
+    from app import create_app
+
+    app = create_app()
+    seed(app)
+
+    def on_exception(sender, exception, **extra):
+        if 'locked' in str(exception):
+            lock_errors.append(type(exception).__name__)
+
+    got_request_exception.connect(on_exception, app)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return app, server, tmp
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *a, **kw):
+        return None
+
+
+class VirtualUser:
+    def __init__(self, base, username, password, results):
+        self.base = base
+        self.username, self.password = username, password
+        self.results = results
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+        self.currency_ids = []
+
+    def request(self, route, path, data=None, expect=(200,)):
+        """Timed request; redirects are not followed. Returns the body, or None on failure."""
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base + path, data=body, headers={'Accept-Encoding': 'gzip'})
+        started = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                status, payload, encoding = resp.status, resp.read(), resp.headers.get('Content-Encoding')
+        except urllib.error.HTTPError as e:
+            status, payload, encoding = e.code, e.read(), e.headers.get('Content-Encoding')
+        except (urllib.error.URLError, OSError):
+            status, payload, encoding = 0, b'', None
+        elapsed = time.perf_counter() - started
+        ok = status in expect
+        self.results[route].append((elapsed, ok, status))
+        if not ok:
+            return None
+        return gzip.decompress(payload).decode('utf-8', 'replace') if encoding == 'gzip' else payload
+
+    def login(self):
+        page = self.request('login_form', '/login')
+        token = CSRF.search(page or '')
+        if not token:
+            return False
+        return self.request('login', '/login', {'csrf_token': token.group(1), 'username': self.username,
+                                                'password': self.password}, expect=(302,)) is not None
+
+    def transaction_add(self):
+        page = self.request('transaction_form', '/transaction/add')
+        token = CSRF.search(page or '')
+        if not token:
+            return
+        self.currency_ids = self.currency_ids or OPTION.findall(page)
+        self.request('transaction_add', '/transaction/add', {
+            'csrf_token': token.group(1), 'type': random.choice(('buy', 'sell')),
+            'currency_id': random.choice(self.currency_ids), 'quantity': round(random.uniform(10, 2000), 2),
+            'notes': 'loadtest'}, expect=(302,))
+
+    def run(self, start_at, stop_at):
+        time.sleep(max(0.0, start_at - time.time()))
+        if not self.login():
+            return
+        names = [name for name, _ in ACTIONS]
+        weights = [weight for _, weight in ACTIONS]
+        while time.time() < stop_at:
+            action = random.choices(names, weights)[0]
+            if action == 'transaction_add':
+                self.transaction_add()
+            elif action == 'quote':
+                self.request('quote', f"/api/quote?from={random.choice(CURRENCIES)[0]}&to=IQD&amount=100")
+            else:
+                self.request(action, GET_ROUTES[action])
+            if args.think:
+                time.sleep(random.expovariate(1 / args.think))
+
+
+def summarize(results, elapsed):
+    routes = {}
+    for route, samples in sorted(results.items()):
+        lat = np.array([s[0] for s in samples]) * 1000
+        errors = sum(1 for s in samples if not s[1])
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+        routes[route] = {'count': len(samples), 'rps': len(samples) / elapsed, 'p50_ms': p50, 'p95_ms': p95,
+                         'p99_ms': p99, 'max_ms': lat.max(), 'errors': errors,
+                         'statuses': {str(k): v for k, v in sorted(_count(s[2] for s in samples).items())}}
+    total = sum(r['count'] for r in routes.values())
+    errors = sum(r['errors'] for r in routes.values())
+    return {'users': args.users, 'seconds': elapsed, 'requests': total, 'rps': total / elapsed,
+            'errors': errors, 'error_rate': errors / total if total else 0.0, 'lock_errors': len(lock_errors),
+            'transactions_per_second': routes.get('transaction_add', {}).get('count', 0) / elapsed,
+            'routes': routes}
+
+
+def _count(values):
+    counts = defaultdict(int)
+    for v in values:
+        counts[v] += 1
+    return counts
+
+
+app = server = tmp = None
+if args.url:
+    base = args.url.rstrip('/')
+    logins = [(args.username, args.password)] * args.users
+else:
+    print(f"Seeding {args.history:,} transactions, {args.branches} branches, {args.users} tellers…")
+    app, server, tmp = boot()
+    base = f'http://127.0.0.1:{server.port}'
+    logins = [(f'teller{n}', PASSWORD) for n in range(args.users)]
+
+results = defaultdict(list)
+now = time.time()
+stop_at = now + args.duration
+users = [VirtualUser(base, username, password, results) for username, password in logins]
+threads = [threading.Thread(target=u.run, args=(now + n * args.ramp / max(args.users, 1), stop_at))
+           for n, u in enumerate(users)]
+print(f"{args.users} virtual users for {args.duration:.0f}s against {base}")
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+elapsed = time.time() - now
+if server is not None:
+    server.shutdown()
+
+report = summarize(results, elapsed)
+print(f"{'route':<18}{'count':>7}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>8}")
+for route, r in report['routes'].items():
+    print(f"{route:<18}{r['count']:>7}{r['rps']:>8.1f}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+          f"{r['max_ms']:>9.1f}{r['errors']:>8}")
+print(f"Total {report['requests']:,} requests in {elapsed:.1f}s: {report['rps']:.1f} req/s, "
+      f"{report['transactions_per_second']:.1f} transactions/s, error rate {report['error_rate']:.2%}, "
+      f"{report['lock_errors']} lock errors")
+
+failed = report['error_rate'] > args.max_error_rate
+if app is not None:
+    from ledger import verify_cashbox
+    with app.app_context():
+        divergent = [r for r in verify_cashbox() if r['first_bad']]
+    report['ledger_consistent'] = not divergent
+    print("✅ Cashbox ledgers consistent" if not divergent else f"❌ {len(divergent)} cashbox ledgers diverged")
+    failed = failed or bool(divergent)
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f"Results written to {args.json}")
+
+if failed:
+    print(f"❌ Error rate above {args.max_error_rate:.0%} or inconsistent ledger")
+    sys.exit(1)
+print("✅ Load test passed")
@@ -1,14 +1,24 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+from sqlalchemy import event
 
 db = SQLAlchemy()
 
+class Branch(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    code = db.Column(db.String(10), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(20), default='viewer')
+    # NULL = head office: sees and reports on every branch
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
+    branch = db.relationship('Branch')
 
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -22,9 +32,20 @@ class Currency(db.Model):
     rate = db.Column(db.Float, nullable=False, default=1.0)
     last_update = db.Column(db.DateTime, default=datetime.utcnow)
 
+class PairSpread(db.Model):
+    """هامش التسعير لزوج عملات بالنقاط الأساسية (من عملة إلى أخرى)."""
+    __table_args__ = (db.UniqueConstraint('from_currency_id', 'to_currency_id', name='uq_pair_spread'),)
+    id = db.Column(db.Integer, primary_key=True)
+    from_currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
+    from_currency = db.relationship('Currency', foreign_keys=[from_currency_id])
+    to_currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
+    to_currency = db.relationship('Currency', foreign_keys=[to_currency_id])
+    spread_bps = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     type = db.Column(db.String(10))
     currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'))
     currency = db.relationship('Currency')
@@ -34,24 +55,38 @@ class Transaction(db.Model):
     total_value_local = db.Column(db.Float)
     profit = db.Column(db.Float)
     notes = db.Column(db.String(255))
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'), index=True)
+    branch = db.relationship('Branch')
 
 class Cashbox(db.Model):
+    __table_args__ = (
+        db.Index('ix_cashbox_currency_date', 'currency_id', 'date'),
+        db.Index('ix_cashbox_branch_currency_date', 'branch_id', 'currency_id', 'date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, default=datetime.utcnow)
     currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'))
     currency = db.relationship('Currency')
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
+    branch = db.relationship('Branch')
     inflow = db.Column(db.Float, default=0.0)
     outflow = db.Column(db.Float, default=0.0)
     balance_after = db.Column(db.Float, default=0.0)
+    # Source of the movement; plain ids, not FKs, so a stray movement is reported by
+    # verify_ledger.py as orphaned instead of blocking the delete
+    transaction_id = db.Column(db.Integer, index=True)
+    expense_id = db.Column(db.Integer, index=True)
 
 class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     category = db.Column(db.String(64), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'))
     currency = db.relationship('Currency')
     notes = db.Column(db.String(255))
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'), index=True)
+    branch = db.relationship('Branch')
 
 class ExchangeDiff(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -63,6 +98,10 @@ class ExchangeDiff(db.Model):
     date = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Debt(db.Model):
+    __table_args__ = (
+        db.Index('ix_debt_paid_due', 'is_paid', 'due_date'),
+        db.Index('ix_debt_person', 'person_name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, default=datetime.utcnow)
     person_name = db.Column(db.String(100), nullable=False)
@@ -71,4 +110,144 @@ class Debt(db.Model):
     currency = db.relationship('Currency')
     due_date = db.Column(db.Date)
     notes = db.Column(db.String(255))
-    is_paid = db.Column(db.Boolean, default=False)
\ No newline at end of file
+    is_paid = db.Column(db.Boolean, default=False)
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'), index=True)
+    branch = db.relationship('Branch')
+
+class DailyClose(db.Model):
+    """نقطة إقفال يومية ثابتة لكل فرع وعملة (رصيد الإقفال وحركة اليوم وربحه)."""
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)
+    currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
+    currency = db.relationship('Currency')
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
+    branch = db.relationship('Branch')
+    opening_balance = db.Column(db.Float, default=0.0)
+    inflow = db.Column(db.Float, default=0.0)
+    outflow = db.Column(db.Float, default=0.0)
+    closing_balance = db.Column(db.Float, default=0.0)
+    profit = db.Column(db.Float, default=0.0)
+    closed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    closed_by = db.Column(db.String(80))
+
+# One close per day, branch and currency. An expression index because SQLite
+# treats NULLs as distinct in UNIQUE, which would let the head-office ledger
+# (branch_id NULL) be closed twice.
+db.Index('ux_daily_close_day_branch_currency', DailyClose.day, db.func.coalesce(DailyClose.branch_id, 0),
+         DailyClose.currency_id, unique=True)
+
+class Position(db.Model):
+    """المركز الحالي لكل فرع وعملة: الكمية المحتفظ بها ومتوسط كلفتها والربح المحقق."""
+    __table_args__ = (db.UniqueConstraint('branch_id', 'currency_id', name='uq_position_branch_currency'),)
+    id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'))
+    branch = db.relationship('Branch')
+    currency_id = db.Column(db.Integer, db.ForeignKey('currency.id'), nullable=False)
+    currency = db.relationship('Currency')
+    quantity = db.Column(db.Float, default=0.0)
+    avg_cost = db.Column(db.Float, default=0.0)
+    realized_pnl = db.Column(db.Float, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PositionEntry(db.Model):
+    """حالة المركز بعد كل عملية، ليُعاد الحساب من نقطة التعديل فقط."""
+    __table_args__ = (db.Index('ix_position_entry_key', 'branch_id', 'currency_id', 'date', 'transaction_id'),)
+    id = db.Column(db.Integer, primary_key=True)
+    transaction_id = db.Column(db.Integer, nullable=False, unique=True)
+    branch_id = db.Column(db.Integer)
+    currency_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+    quantity = db.Column(db.Float)  # signed: + buy, - sell
+    price = db.Column(db.Float)
+    quantity_after = db.Column(db.Float)
+    avg_cost_after = db.Column(db.Float)
+    realized_pnl = db.Column(db.Float)
+    cumulative_realized = db.Column(db.Float)
+    lots = db.Column(db.Text)  # open FIFO lots as JSON [[qty, price], ...]; NULL for average cost
+
+class ChangeLog(db.Model):
+    """سجل تغييرات للإضافة فقط، تملؤه مشغلات SQLite (انظر changes.py)."""
+    __tablename__ = 'change_log'
+    # AUTOINCREMENT: seq never goes backwards or reuses a value, even after deletes
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(32), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(1), nullable=False)  # I, U or D
+    changed_at = db.Column(db.String(32))  # UTC text written by the trigger
+    branch_id = db.Column(db.Integer)  # copied from the row for branch scoping
+    data = db.Column(db.Text)  # JSON image of the row (the old row for deletes)
+
+@event.listens_for(DailyClose, 'before_update')
+@event.listens_for(DailyClose, 'before_delete')
+def _daily_close_is_immutable(mapper, connection, target):
+    raise ValueError('Daily close checkpoints are immutable')
+
+def configure_sqlite(app):
+    """Connection pragmas for concurrent tellers on SQLite.
+
+    WAL lets pages keep reading while one request writes, and busy_timeout
+    makes concurrent writers queue for the write lock instead of failing with
+    "database is locked".
+    """
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'connect')
+    def _pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(app.config.get('SQLITE_BUSY_TIMEOUT_MS', 10000))}")
+        if app.config.get('SQLITE_WAL', True):
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+
+def ensure_schema():
+    """Create missing tables, nullable columns and indexes.
+
+    create_all only creates whole tables, so columns and indexes added to an
+    existing model are applied here for databases created by older versions.
+    """
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    ddl = column.type.compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {ddl}'))
+    _rebuild_daily_close()
+    # Looked up by name: the SQLite inspector does not report expression indexes
+    with db.engine.connect() as conn:
+        existing = set(conn.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+
+def _rebuild_daily_close():
+    """Drop the table-level UNIQUE constraints older versions put on daily_close.
+
+    Both (day, currency_id) and (day, branch_id, currency_id) are replaced by
+    the expression index above. SQLite cannot drop a constraint, so the table
+    is copied into a fresh one.
+    """
+    with db.engine.begin() as conn:
+        sql = conn.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'daily_close'")).scalar()
+        if not sql or 'UNIQUE' not in sql.upper():
+            return
+        table = DailyClose.__table__
+        columns = ', '.join(f'"{c.name}"' for c in table.columns)
+        for (name,) in conn.execute(db.text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'daily_close' AND sql IS NOT NULL")):
+            conn.execute(db.text(f'DROP INDEX "{name}"'))
+        conn.execute(db.text('ALTER TABLE daily_close RENAME TO daily_close_old'))
+        table.create(conn)
+        conn.execute(db.text(f'INSERT OR IGNORE INTO daily_close ({columns}) SELECT {columns} FROM daily_close_old ORDER BY id'))
+        conn.execute(db.text('DROP TABLE daily_close_old'))
@@ -0,0 +1,224 @@
+import json
+import numpy as np
+from flask import current_app
+from models import db, Currency, Transaction, Position, PositionEntry
+from branches import ALL_BRANCHES, apply_scope
+
+# Each transaction moves the position of its (branch, currency) by a signed
+# quantity: + for a buy at buy_rate, - for a sell at sell_rate. The position is
+# carried at weighted-average cost, or as FIFO lots when COST_BASIS_METHOD is
+# 'fifo'. A PositionEntry stores the state after every transaction so edits,
+# deletes and back-dated postings replay only from the affected point.
+
+
+def _method():
+    return current_app.config.get('COST_BASIS_METHOD', 'average')
+
+
+def _trade(tx_type, quantity, buy_rate, sell_rate):
+    qty = quantity or 0
+    if tx_type == 'buy':
+        return qty, buy_rate or sell_rate or 0
+    return -qty, sell_rate or buy_rate or 0
+
+
+def _sign(x):
+    return (x > 0) - (x < 0)
+
+
+def _step_average(qty, avg, d, p):
+    """Apply a signed trade to a weighted-average position. Returns (qty, avg, realized)."""
+    if d == 0:
+        return qty, avg, 0.0
+    if qty == 0 or _sign(qty) == _sign(d):
+        new_qty = qty + d
+        return new_qty, (avg * abs(qty) + p * abs(d)) / abs(new_qty), 0.0
+    closing = min(abs(d), abs(qty))
+    realized = closing * (p - avg) * _sign(qty)
+    new_qty = qty + d
+    if new_qty == 0:
+        return 0.0, 0.0, realized
+    # Crossing zero opens a position on the other side at the trade price
+    return new_qty, (avg if _sign(new_qty) == _sign(qty) else p), realized
+
+
+def _step_fifo(lots, d, p):
+    """Apply a signed trade to FIFO lots ([[qty, price], ...], mutated). Returns realized."""
+    realized = 0.0
+    remaining = d
+    while remaining and lots and _sign(lots[0][0]) != _sign(remaining):
+        lot = lots[0]
+        take = min(abs(remaining), abs(lot[0]))
+        realized += take * (p - lot[1]) * _sign(lot[0])
+        lot[0] += take * _sign(remaining)
+        remaining -= take * _sign(remaining)
+        if lot[0] == 0:
+            lots.pop(0)
+    if remaining:
+        lots.append([remaining, p])
+    return realized
+
+
+def _replay(state, trades, method):
+    """Run trades [(tx_id, date, d, p), ...] from `state` and return entry rows."""
+    qty, avg, cumulative, lots = state
+    rows = []
+    for tx_id, date, d, p in trades:
+        if method == 'fifo':
+            realized = _step_fifo(lots, d, p)
+            qty = sum(q for q, _ in lots)
+            avg = sum(abs(q) * price for q, price in lots) / abs(qty) if qty else 0.0
+        else:
+            qty, avg, realized = _step_average(qty, avg, d, p)
+        cumulative += realized
+        rows.append({
+            'transaction_id': tx_id, 'date': date, 'quantity': d, 'price': p,
+            'quantity_after': qty, 'avg_cost_after': avg,
+            'realized_pnl': realized, 'cumulative_realized': cumulative,
+            'lots': json.dumps(lots) if method == 'fifo' else None,
+        })
+    return rows
+
+
+def _after_key(model, id_col, date, tx_id):
+    return db.or_(model.date > date, db.and_(model.date == date, id_col >= tx_id))
+
+
+def _state_before(branch_id, currency_id, date, tx_id):
+    prev = (PositionEntry.query
+            .filter(PositionEntry.branch_id == branch_id, PositionEntry.currency_id == currency_id,
+                    db.not_(_after_key(PositionEntry, PositionEntry.transaction_id, date, tx_id)))
+            .order_by(PositionEntry.date.desc(), PositionEntry.transaction_id.desc())
+            .first())
+    if prev is None:
+        return 0.0, 0.0, 0.0, []
+    return prev.quantity_after, prev.avg_cost_after, prev.cumulative_realized, json.loads(prev.lots or '[]')
+
+
+def _save_position(branch_id, currency_id, qty, avg, realized):
+    pos = Position.query.filter_by(branch_id=branch_id, currency_id=currency_id).first()
+    if pos is None:
+        pos = Position(branch_id=branch_id, currency_id=currency_id)
+        db.session.add(pos)
+    pos.quantity, pos.avg_cost, pos.realized_pnl = qty, avg, realized
+
+
+def recompute_from(branch_id, currency_id, date, tx_id=0):
+    """Rebuild entries of one position from (date, tx_id) onward and refresh the position."""
+    db.session.query(PositionEntry).filter(
+        PositionEntry.branch_id == branch_id, PositionEntry.currency_id == currency_id,
+        _after_key(PositionEntry, PositionEntry.transaction_id, date, tx_id),
+    ).delete(synchronize_session=False)
+
+    state = _state_before(branch_id, currency_id, date, tx_id)
+    txs = (db.session.query(Transaction.id, Transaction.date, Transaction.type,
+                            Transaction.quantity, Transaction.buy_rate, Transaction.sell_rate)
+           .filter(Transaction.branch_id == branch_id, Transaction.currency_id == currency_id,
+                   _after_key(Transaction, Transaction.id, date, tx_id))
+           .order_by(Transaction.date, Transaction.id)
+           .all())
+    trades = [(i, dt, *_trade(t, q, b, s)) for i, dt, t, q, b, s in txs]
+    rows = _replay(state, trades, _method())
+    if rows:
+        db.session.execute(db.insert(PositionEntry),
+                           [dict(r, branch_id=branch_id, currency_id=currency_id) for r in rows])
+        last = rows[-1]
+        _save_position(branch_id, currency_id, last['quantity_after'], last['avg_cost_after'], last['cumulative_realized'])
+    else:
+        qty, avg, cumulative, _ = state
+        _save_position(branch_id, currency_id, qty, avg, cumulative)
+
+
+def record_transaction(tx):
+    """Update the position for a newly added transaction (call after flush).
+
+    The common case, a trade newer than every recorded one, is a single step.
+    A back-dated trade replays the position from its own point.
+    """
+    later = (db.session.query(PositionEntry.id)
+             .filter(PositionEntry.branch_id == tx.branch_id, PositionEntry.currency_id == tx.currency_id,
+                     _after_key(PositionEntry, PositionEntry.transaction_id, tx.date, tx.id))
+             .first())
+    if later is not None:
+        return recompute_from(tx.branch_id, tx.currency_id, tx.date, tx.id)
+
+    state = _state_before(tx.branch_id, tx.currency_id, tx.date, tx.id)
+    d, p = _trade(tx.type, tx.quantity, tx.buy_rate, tx.sell_rate)
+    row = _replay(state, [(tx.id, tx.date, d, p)], _method())[0]
+    db.session.add(PositionEntry(branch_id=tx.branch_id, currency_id=tx.currency_id, **row))
+    _save_position(tx.branch_id, tx.currency_id, row['quantity_after'], row['avg_cost_after'], row['cumulative_realized'])
+
+
+def rebuild_all():
+    """Full rebuild of every position from the transaction history (back-fills).
+
+    Transactions are loaded once as columns, and signed quantities, prices and
+    position boundaries are derived with NumPy over the whole table. Only the
+    cost recurrence, which depends on the previous average, is stepped per row,
+    and entries are written back with a single bulk insert.
+    """
+    method = _method()
+    rows = (db.session.query(Transaction.id, Transaction.date, Transaction.branch_id, Transaction.currency_id,
+                             Transaction.type, Transaction.quantity, Transaction.buy_rate, Transaction.sell_rate)
+            .order_by(Transaction.branch_id, Transaction.currency_id, Transaction.date, Transaction.id)
+            .all())
+    db.session.query(PositionEntry).delete(synchronize_session=False)
+    db.session.query(Position).delete(synchronize_session=False)
+    if not rows:
+        db.session.commit()
+        return 0
+
+    ids, dates, branch_ids, currency_ids, types, qtys, buys, sells = zip(*rows)
+    branch_arr = np.array([-1 if b is None else b for b in branch_ids], dtype=np.int64)
+    currency_arr = np.array(currency_ids, dtype=np.int64)
+    qty_arr = np.nan_to_num(np.array(qtys, dtype=np.float64))
+    buy_arr = np.nan_to_num(np.array(buys, dtype=np.float64))
+    sell_arr = np.nan_to_num(np.array(sells, dtype=np.float64))
+    is_buy = np.array(types) == 'buy'
+    signed = np.where(is_buy, qty_arr, -qty_arr)
+    price = np.where(is_buy, np.where(buy_arr != 0, buy_arr, sell_arr), np.where(sell_arr != 0, sell_arr, buy_arr))
+
+    # Group boundaries: one slice per (branch, currency)
+    change = np.flatnonzero((np.diff(branch_arr) != 0) | (np.diff(currency_arr) != 0)) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(rows)]))
+
+    entries = []
+    for start, end in zip(starts, ends):
+        trades = list(zip(ids[start:end], dates[start:end], signed[start:end].tolist(), price[start:end].tolist()))
+        group = _replay((0.0, 0.0, 0.0, []), trades, method)
+        branch_id, currency_id = branch_ids[start], currency_ids[start]
+        for r in group:
+            r['branch_id'], r['currency_id'] = branch_id, currency_id
+        entries.extend(group)
+        last = group[-1]
+        db.session.add(Position(branch_id=branch_id, currency_id=currency_id, quantity=last['quantity_after'],
+                                avg_cost=last['avg_cost_after'], realized_pnl=last['cumulative_realized']))
+    db.session.execute(db.insert(PositionEntry), entries)
+    db.session.commit()
+    return len(entries)
+
+
+def positions_report(branch_id=ALL_BRANCHES):
+    """Held quantity, average cost, realized and unrealized P&L per currency.
+
+    Unrealized P&L marks the open quantity to the currency's current rate. With
+    ALL_BRANCHES the branch positions are summed per currency.
+    """
+    rows = (apply_scope(db.session.query(Currency.code, Currency.rate, Position.quantity,
+                                         Position.avg_cost, Position.realized_pnl)
+                        .join(Currency, Currency.id == Position.currency_id), Position, branch_id)
+            .order_by(Currency.id)
+            .all())
+    report = {}
+    for code, rate, qty, avg, realized in rows:
+        r = report.setdefault(code, {'currency': code, 'rate': rate, 'quantity': 0.0, 'cost': 0.0,
+                                     'realized': 0.0, 'unrealized': 0.0})
+        r['quantity'] += qty or 0
+        r['cost'] += (qty or 0) * (avg or 0)
+        r['realized'] += realized or 0
+        r['unrealized'] += (qty or 0) * ((rate or 0) - (avg or 0))
+    for r in report.values():
+        r['avg_cost'] = r['cost'] / r['quantity'] if r['quantity'] else 0.0
+        r['market_value'] = r['quantity'] * (r['rate'] or 0)
+    return list(report.values())
@@ -0,0 +1,132 @@
+import threading
+import time
+import numpy as np
+from flask import current_app
+from models import db, Currency, PairSpread
+
+# Cross rates for every currency pair live in NumPy matrices indexed by
+# currency position: mid[i, j] is how many units of j one unit of i buys,
+# derived from each currency's rate against the local unit. rate[i, j] is the
+# customer rate after the pair spread. Quotes only index into the current
+# snapshot. It is rebuilt right after rates or spreads change in this process,
+# and a cheap version query, at most every QUOTE_REFRESH_SECONDS, picks up
+# changes made by other workers.
+
+
+class QuoteError(ValueError):
+    pass
+
+
+class QuoteEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+
+    def _version(self):
+        return tuple(db.session.query(
+            db.select(db.func.max(Currency.last_update)).scalar_subquery(),
+            db.select(db.func.count(Currency.id)).scalar_subquery(),
+            db.select(db.func.max(PairSpread.updated_at)).scalar_subquery(),
+            db.select(db.func.count(PairSpread.id)).scalar_subquery(),
+        ).one())
+
+    def _build(self):
+        currencies = Currency.query.order_by(Currency.id).all()
+        n = len(currencies)
+        position = {c.id: i for i, c in enumerate(currencies)}
+        rates = np.array([c.rate or 0 for c in currencies], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mid = rates[:, None] / rates[None, :]
+        mid[~np.isfinite(mid) | (mid <= 0)] = np.nan  # a zero rate cannot be quoted
+
+        spread = np.full((n, n), current_app.config.get('QUOTE_DEFAULT_SPREAD_BPS', 50.0))
+        np.fill_diagonal(spread, 0.0)
+        for s in PairSpread.query.all():
+            if s.from_currency_id in position and s.to_currency_id in position:
+                spread[position[s.from_currency_id], position[s.to_currency_id]] = s.spread_bps
+        return {
+            'version': self._version(),
+            'codes': [c.code for c in currencies],
+            'index': {c.code: i for i, c in enumerate(currencies)},
+            'mid': mid,
+            'spread': spread,
+            'rate': mid * (1 - spread / 10000.0),
+        }
+
+    def rebuild(self):
+        """Rebuild the matrices now (call after committing rate or spread changes)."""
+        with self._lock:
+            self._snapshot = self._build()
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+    def snapshot(self):
+        snap = self._snapshot
+        if snap is not None and time.monotonic() - self._checked_at < current_app.config.get('QUOTE_REFRESH_SECONDS', 5):
+            return snap
+        with self._lock:
+            if self._snapshot is None or self._snapshot['version'] != self._version():
+                self._snapshot = self._build()
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+    def _position(self, snap, code):
+        try:
+            return snap['index'][code.upper()]
+        except (KeyError, AttributeError):
+            raise QuoteError(f'unknown currency {code}')
+
+    def quote(self, from_code, to_code, amount=1.0):
+        """Convert `amount` of from_code into to_code at the customer rate."""
+        snap = self.snapshot()
+        i, j = self._position(snap, from_code), self._position(snap, to_code)
+        rate = float(snap['rate'][i, j])
+        if np.isnan(rate):
+            raise QuoteError(f'no rate for {from_code}/{to_code}')
+        return {
+            'from': snap['codes'][i], 'to': snap['codes'][j], 'amount': amount,
+            'mid': float(snap['mid'][i, j]), 'spread_bps': float(snap['spread'][i, j]),
+            'rate': rate, 'result': amount * rate,
+        }
+
+    def quote_many(self, requests):
+        """Quote [(from, to, amount), ...] with one vectorised lookup.
+
+        Unknown currencies and unpriced pairs produce an entry with an 'error'
+        key instead of a rate.
+        """
+        snap = self.snapshot()
+        if not snap['codes']:
+            # No currencies: the matrices are 0x0 and cannot be indexed at all
+            return [{'from': f, 'to': t, 'amount': a, 'error': 'unknown currency'} for f, t, a in requests]
+        index = snap['index']
+        n = len(requests)
+        fi = np.fromiter((index.get(str(f).upper(), -1) for f, _, _ in requests), dtype=np.int64, count=n)
+        ti = np.fromiter((index.get(str(t).upper(), -1) for _, t, _ in requests), dtype=np.int64, count=n)
+        amounts = np.fromiter((a for _, _, a in requests), dtype=np.float64, count=n)
+        ok = (fi >= 0) & (ti >= 0)
+        fi_ok, ti_ok = np.where(ok, fi, 0), np.where(ok, ti, 0)
+        mid, spread, rate = snap['mid'][fi_ok, ti_ok], snap['spread'][fi_ok, ti_ok], snap['rate'][fi_ok, ti_ok]
+        results = amounts * rate
+        priced = ok & ~np.isnan(rate)
+
+        out = []
+        for k, (f, t, a) in enumerate(requests):
+            if not priced[k]:
+                out.append({'from': f, 'to': t, 'amount': a,
+                            'error': 'no rate' if ok[k] else 'unknown currency'})
+            else:
+                out.append({'from': snap['codes'][fi[k]], 'to': snap['codes'][ti[k]], 'amount': a,
+                            'mid': float(mid[k]), 'spread_bps': float(spread[k]),
+                            'rate': float(rate[k]), 'result': float(results[k])})
+        return out
+
+    def matrix(self):
+        """Codes and the customer-rate matrix as nested lists (NaN -> None)."""
+        snap = self.snapshot()
+        rate = snap['rate']
+        return snap['codes'], [[None if np.isnan(v) else float(v) for v in row] for row in rate]
+
+
+engine = QuoteEngine()
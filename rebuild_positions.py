@@ -0,0 +1,12 @@
+# rebuild_positions.py
+# إعادة بناء مراكز العملات بالكامل من سجل العمليات (بعد استيراد بيانات أو تغيير COST_BASIS_METHOD)
+import time
+from app import create_app
+from positions import rebuild_all
+
+app = create_app()
+app.app_context().push()
+
+started = time.perf_counter()
+count = rebuild_all()
+print(f"✅ Rebuilt {count} position entries ({app.config.get('COST_BASIS_METHOD', 'average')}) in {time.perf_counter() - started:.2f}s")
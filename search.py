@@ -0,0 +1,178 @@
+import re
+from datetime import timedelta
+from flask import url_for
+from sqlalchemy import text
+from models import db, Transaction, Debt, Expense
+from branches import ALL_BRANCHES
+
+# A single FTS5 table indexes all three sources. The rowid encodes the source
+# row as id * 4 + kind, so triggers update and delete by primary key instead of
+# scanning the index. branch_id is stored with each row so branch tellers are
+# filtered before ranking and LIMIT, not after.
+KINDS = {'transaction': 1, 'debt': 2, 'expense': 3}
+KIND_NAMES = {v: k for k, v in KINDS.items()}
+MODELS = {'transaction': Transaction, 'debt': Debt, 'expense': Expense}
+
+# Arabic normalisation applied identically to indexed text (inside the triggers)
+# and to queries: drop harakat/tatweel and fold letter variants that users type
+# interchangeably. unicode61 alone would treat "مُحَمَّد" and "محمد" as different tokens.
+ARABIC_FOLDS = [(chr(c), '') for c in range(0x064B, 0x0653)] + [
+    ('\u0670', ''),        # superscript alef
+    ('\u0640', ''),        # tatweel
+    ('\u0623', '\u0627'),  # alef with hamza above -> alef
+    ('\u0625', '\u0627'),  # alef with hamza below -> alef
+    ('\u0622', '\u0627'),  # alef with madda -> alef
+    ('\u0671', '\u0627'),  # alef wasla -> alef
+    ('\u0629', '\u0647'),  # teh marbuta -> heh
+    ('\u0649', '\u064A'),  # alef maksura -> yeh
+]
+
+# (table, kind, name column, notes column)
+SOURCES = [
+    ('"transaction"', 'transaction', None, 'notes'),
+    ('debt', 'debt', 'person_name', 'notes'),
+    ('expense', 'expense', 'category', 'notes'),
+]
+
+
+def normalize(value):
+    value = value or ''
+    for src, dst in ARABIC_FOLDS:
+        value = value.replace(src, dst)
+    return value
+
+
+def _normalize_sql(expr):
+    sql = f"coalesce({expr}, '')"
+    for src, dst in ARABIC_FOLDS:
+        sql = f"replace({sql}, '{src}', '{dst}')"
+    return sql
+
+
+def _row_values(prefix, kind, name_col, notes_col):
+    name = _normalize_sql(f'{prefix}.{name_col}') if name_col else "''"
+    return (f"{prefix}.id * 4 + {KINDS[kind]}, {name}, {_normalize_sql(f'{prefix}.{notes_col}')}, "
+            f"{prefix}.currency_id, {prefix}.date, {prefix}.branch_id")
+
+
+def _ddl():
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "name, notes, currency_id UNINDEXED, date UNINDEXED, branch_id UNINDEXED, "
+        "tokenize = 'unicode61 remove_diacritics 2')"
+    ]
+    for table, kind, name_col, notes_col in SOURCES:
+        code = KINDS[kind]
+        statements += [
+            f"CREATE TRIGGER search_{kind}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO search_index(rowid, name, notes, currency_id, date, branch_id) "
+            f"VALUES ({_row_values('new', kind, name_col, notes_col)}); END",
+            f"CREATE TRIGGER search_{kind}_au AFTER UPDATE ON {table} BEGIN "
+            f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code}; "
+            f"INSERT INTO search_index(rowid, name, notes, currency_id, date, branch_id) "
+            f"VALUES ({_row_values('new', kind, name_col, notes_col)}); END",
+            f"CREATE TRIGGER search_{kind}_ad AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code}; END",
+        ]
+    return statements
+
+
+def rebuild_search_index():
+    """Repopulate the index from the source tables (back-fill or repair)."""
+    with db.engine.begin() as conn:
+        conn.execute(text("DELETE FROM search_index"))
+        for table, kind, name_col, notes_col in SOURCES:
+            conn.execute(text(
+                f"INSERT INTO search_index(rowid, name, notes, currency_id, date, branch_id) "
+                f"SELECT {_row_values('s', kind, name_col, notes_col)} FROM {table} AS s"))
+        conn.execute(text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+
+
+def ensure_search_index():
+    """Create the FTS5 table and (re)create its sync triggers; back-fill when (re)built.
+
+    FTS5 tables cannot be altered, so an index created before branch_id was
+    added is dropped and rebuilt from the source tables.
+    """
+    with db.engine.connect() as conn:
+        columns = {row[1] for row in conn.execute(text("PRAGMA table_info(search_index)"))}
+    with db.engine.begin() as conn:
+        for _, kind, _, _ in SOURCES:
+            for suffix in ('ai', 'au', 'ad'):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS search_{kind}_{suffix}"))
+        if columns and 'branch_id' not in columns:
+            conn.execute(text("DROP TABLE search_index"))
+        for stmt in _ddl():
+            conn.execute(text(stmt))
+    if 'branch_id' not in columns:
+        rebuild_search_index()
+
+
+def _match_query(q):
+    # Every term must match, as a prefix so partial names still hit. Terms are
+    # quoted so user input can never be parsed as FTS5 query syntax.
+    terms = re.findall(r'\w+', normalize(q))
+    return ' '.join('"%s"*' % t for t in terms)
+
+
+def search(q, kind=None, currency_id=None, date_from=None, date_to=None, limit=50, branch_id=ALL_BRANCHES):
+    """Ranked matches as a list of dicts, best first. Empty list for an empty query.
+
+    With a branch_id only that branch's rows are ranked and limited.
+    """
+    match = _match_query(q)
+    if not match:
+        return []
+    sql = ["SELECT rowid, bm25(search_index, 5.0, 1.0) AS rank FROM search_index WHERE search_index MATCH :match"]
+    params = {'match': match, 'limit': limit}
+    if kind in KINDS:
+        sql.append("AND rowid % 4 = :kind")
+        params['kind'] = KINDS[kind]
+    if branch_id is not ALL_BRANCHES:
+        sql.append("AND branch_id IS :branch_id")
+        params['branch_id'] = branch_id
+    if currency_id:
+        sql.append("AND currency_id = :currency_id")
+        params['currency_id'] = currency_id
+    if date_from:
+        sql.append("AND date >= :date_from")
+        params['date_from'] = date_from.isoformat()
+    if date_to:
+        sql.append("AND date < :date_to")
+        params['date_to'] = (date_to + timedelta(days=1)).isoformat()
+    sql.append("ORDER BY rank LIMIT :limit")
+    hits = db.session.execute(text(' '.join(sql)), params).all()
+
+    wanted = {}
+    for rowid, _ in hits:
+        wanted.setdefault(KIND_NAMES[rowid % 4], []).append(rowid // 4)
+    loaded = {}
+    for name, ids in wanted.items():
+        model = MODELS[name]
+        for obj in model.query.filter(model.id.in_(ids)).all():
+            loaded[(name, obj.id)] = obj
+
+    results = []
+    for rowid, rank in hits:
+        name = KIND_NAMES[rowid % 4]
+        obj = loaded.get((name, rowid // 4))
+        if obj is None:
+            continue
+        if name == 'transaction':
+            title, amount = obj.type, obj.quantity
+        elif name == 'debt':
+            title, amount = obj.person_name, obj.amount
+        else:
+            title, amount = obj.category, obj.amount
+        results.append({
+            'kind': name,
+            'id': obj.id,
+            'date': obj.date.strftime('%Y-%m-%d %H:%M') if obj.date else None,
+            'currency': obj.currency.code if obj.currency else None,
+            'title': title,
+            'amount': amount,
+            'notes': obj.notes,
+            'url': url_for(f'{name}_edit', id=obj.id),
+            'rank': rank,
+        })
+    return results
@@ -0,0 +1,66 @@
+import os
+import threading
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+# Compiled templates are kept on disk so a restarted worker loads bytecode
+# instead of re-parsing every template. Layout fragments that depend only on a
+# few values (role, route, company settings) are rendered once per key by the
+# {% cache %} tag below.
+FRAGMENT_CACHE_SIZE = 512
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache key, ... %}...{% endcache %}: memoise the rendered block per key.
+
+    The key expressions must cover everything the block reads; the cache is a
+    bounded in-process LRU and is bypassed while templates auto-reload.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=OrderedDict(), fragment_cache_enabled=True,
+                           fragment_cache_lock=threading.Lock())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        keys = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        key = nodes.Tuple(keys, 'load', lineno=lineno)
+        return nodes.CallBlock(self.call_method('_render', [key]), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        env = self.environment
+        if not env.fragment_cache_enabled or env.auto_reload:
+            return caller()
+        cache, lock = env.fragment_cache, env.fragment_cache_lock
+        with lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        html = caller()
+        with lock:
+            cache[key] = html
+            if len(cache) > FRAGMENT_CACHE_SIZE:
+                cache.popitem(last=False)
+        return html
+
+
+def init_app(app):
+    """Enable the on-disk bytecode cache and the {% cache %} fragment tag."""
+    env = app.jinja_env
+    env.add_extension(FragmentCacheExtension)
+    env.fragment_cache_enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            app.logger.warning('Template cache dir %s is not writable; compiling in memory', cache_dir)
+        else:
+            env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
@@ -1,8 +1,32 @@
-import pandas as pd
+import threading
 from io import BytesIO
-from xhtml2pdf import pisa
 from flask import make_response
 
+# pandas and xhtml2pdf (with reportlab, pyhanko, ...) take seconds to import,
+# so they are loaded on first export instead of when the app starts.
+# preload_exports() pulls them in ahead of time for long-running workers.
+
+
+def _pandas():
+    import pandas
+    return pandas
+
+
+def _pisa():
+    from xhtml2pdf import pisa
+    return pisa
+
+
+def preload_exports(background=True):
+    """Import the export/PDF stack now, in a daemon thread unless background=False."""
+    def load():
+        _pandas()
+        _pisa()
+    if not background:
+        return load()
+    threading.Thread(target=load, name='preload-exports', daemon=True).start()
+
+
 def export_transactions_excel(transactions):
     rows = []
     for t in transactions:
@@ -14,11 +38,11 @@ def export_transactions_excel(transactions):
             'total_local': t.total_value_local,
             'profit': t.profit
         })
+    pd = _pandas()
     df = pd.DataFrame(rows)
     output = BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         df.to_excel(writer, index=False, sheet_name='Transactions')
-        writer.save()
     output.seek(0)
     resp = make_response(output.read())
     resp.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -35,11 +59,11 @@ def export_expenses_excel(expenses):
             'amount': e.amount,
             'notes': e.notes
         })
+    pd = _pandas()
     df = pd.DataFrame(rows)
     output = BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         df.to_excel(writer, index=False, sheet_name='Expenses')
-        writer.save()
     output.seek(0)
     resp = make_response(output.read())
     resp.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -48,7 +72,7 @@ def export_expenses_excel(expenses):
 
 def render_pdf_from_html(html):
     result = BytesIO()
-    pisa.CreatePDF(html, dest=result)
+    _pisa().CreatePDF(html, dest=result)
     result.seek(0)
     resp = make_response(result.read())
     resp.headers['Content-Type'] = 'application/pdf'
@@ -0,0 +1,71 @@
+# verify_ledger.py
+# فحص سلامة دفتر الصندوق: الرصيد التراكمي لكل عملة وفرع، ومطابقة العمليات والمصاريف مع حركات الصندوق
+# python verify_ledger.py [--currency USD] [--workers 8] [--chunk 50000] [--repair [--force]]
+import argparse
+import sys
+import time
+from app import create_app
+from models import db, Branch, Currency
+from branches import HEAD_OFFICE_NAME
+from closing import last_closed_day
+from ledger import CHUNK_ROWS, verify_cashbox, repair_cashbox, match_sources
+
+parser = argparse.ArgumentParser(description='Verify (and optionally repair) the cashbox ledgers.')
+parser.add_argument('--currency', help='only this currency code')
+parser.add_argument('--workers', type=int, default=8)
+parser.add_argument('--chunk', type=int, default=CHUNK_ROWS, help='rows per chunk')
+parser.add_argument('--repair', action='store_true', help='rewrite balance_after from the first divergent row')
+parser.add_argument('--force', action='store_true', help='also repair ledgers whose divergence is in a closed day')
+args = parser.parse_args()
+
+app = create_app()
+app.app_context().push()
+
+currencies = {c.id: c.code for c in Currency.query.all()}
+branches = {b.id: b.name for b in Branch.query.all()}
+currency_id = None
+if args.currency:
+    match = [cid for cid, code in currencies.items() if code == args.currency.upper()]
+    if not match:
+        print(f"❌ Unknown currency {args.currency}")
+        sys.exit(2)
+    currency_id = match[0]
+
+started = time.perf_counter()
+results = verify_cashbox(max_workers=args.workers, chunk_rows=args.chunk, currency_id=currency_id)
+elapsed = time.perf_counter() - started
+rows = sum(r['rows'] for r in results)
+print(f"Checked {rows:,} cashbox rows in {len(results)} ledgers in {elapsed:.2f}s")
+
+divergent = [r for r in results if r['first_bad']]
+for r in results:
+    label = f"{currencies.get(r['currency_id'], r['currency_id'])} / {branches.get(r['branch_id'], HEAD_OFFICE_NAME)}"
+    bad = r['first_bad']
+    if bad is None:
+        print(f"✅ {label}: {r['rows']:,} rows consistent")
+    else:
+        print(f"❌ {label}: first divergent row id={bad['id']} ({bad['date']}) "
+              f"balance_after={bad['balance_after']:,.2f} expected={bad['expected']:,.2f}; "
+              f"{r['bad_rows']:,} rows off, drift at end {r['drift']:,.2f}")
+
+sources = match_sources(currency_id)
+print(f"Sources: {sources['missing']} without a cashbox movement, {sources['mismatched']} with a different amount, "
+      f"{sources['orphaned']} movements whose source was deleted, {sources['unexplained']} movements without a source")
+for kind, examples in sources['examples'].items():
+    for example in examples:
+        print(f"   {kind}: {example}")
+
+if args.repair and divergent:
+    closed = last_closed_day()
+    repaired = 0
+    for r in divergent:
+        day = r['first_bad']['date'].date() if r['first_bad']['date'] else None
+        if closed and day and day <= closed and not args.force:
+            print(f"⚠️  Skipping {currencies.get(r['currency_id'])}: divergence on {day} is inside closed days (use --force)")
+            continue
+        repaired += repair_cashbox(r, max_workers=args.workers, chunk_rows=args.chunk)
+    db.session.commit()
+    print(f"✅ Rewrote balance_after on {repaired:,} rows")
+    divergent = [r for r in verify_cashbox(args.workers, args.chunk, currency_id) if r['first_bad']]
+
+sys.exit(1 if divergent or sources['missing'] or sources['mismatched'] or sources['orphaned'] else 0)